@@ -0,0 +1,459 @@
+#!/usr/bin/env python3
+"""
+SecuBox WAF Detection Benchmark
+Replays a request corpus through the analytics addon (SecuBoxAnalytics) and
+the DPI double buffer (DPIBuffer) offline, without a proxy or network
+Reports requests/s, p50/p99 per-request latency, per-detector time, peak
+memory, addon startup time with and without the rule cache and what each
+corpus entry was detected as, as sorted JSON so two
+runs (e.g. before and after a commit) can be diffed or compared with
+--compare
+
+Usage:
+    python3 waf_bench.py [--corpus corpus.jsonl] [--iterations 20]
+                         [--output run.json] [--compare previous.json]
+                         [--adaptive-order] [--offload-workers N]
+                         [--no-verdict-cache]
+
+Corpus format (one JSON object per line):
+    name, kind        entry id and group (clean, scanner, attack, large)
+    method, host, path, headers
+    body              request body as text, or
+    body_fill         {"size": N, "text": "..."} - text repeated to N bytes;
+                      with "multipart": "<type>" the fill becomes one file
+                      part of that type, using the boundary of the
+                      content-type header
+    weight            times the entry is replayed per iteration (default 1)
+    client_ip         source address (default: one of a pool of clients)
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Dict, List, Optional
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ANALYTICS_DIR = os.path.join(HERE, '..', 'files', 'srv', 'mitmproxy', 'addons')
+DPI_DIR = os.path.join(HERE, '..', '..', 'secubox-dpi-dual', 'files', 'srv', 'mitmproxy', 'addons')
+DEFAULT_CORPUS = os.path.join(HERE, 'corpus.jsonl')
+# Rules file shipped with the package, evaluated by the analytics addon
+WAF_RULES = os.path.join(HERE, '..', 'files', 'srv', 'mitmproxy', 'waf-rules.json')
+
+# Analytics module paths redirected into the scratch directory
+ANALYTICS_PATHS = {
+    'GEOIP_DB': 'GeoLite2-Country.mmdb',
+    'LOG_FILE': 'secubox-access.log',
+    'CROWDSEC_LOG': 'threats.log',
+    'ALERTS_FILE': 'secubox-mitm-alerts.json',
+    'STATS_FILE': 'secubox-mitm-stats.json',
+    'SERIES_FILE': 'stats-series.jsonl',
+    'RULE_STATS_FILE': 'secubox-mitm-rule-stats.json',
+    'AUTOBAN_FILE': 'autoban-requests.log',
+    'AUTOBAN_CONFIG': 'autoban.json',
+    'LAPI_CREDENTIALS': 'lapi-credentials.json',
+    'REPUTATION_FILE': 'ip-reputation.db',
+}
+
+# Addon constructions timed per rule cache state (the best one is reported)
+STARTUP_RUNS = 3
+
+# Per-detector timers (inclusive: a stage called from another stage counts in both)
+ANALYTICS_STAGES = (
+    '_detect_scan', '_detect_suspicious_headers', '_check_rate_limit',
+    '_get_client_fingerprint', '_detect_bot_behavior', '_get_country',
+    '_should_autoban', '_add_alert', '_log_entry', '_update_stats',
+)
+DPI_STAGES = ('_build_entry', '_quick_threat_check', '_write_stats')
+
+# Clients the corpus is spread over when an entry has no client_ip
+CLIENT_POOL = 64
+
+
+def load_corpus(path: str) -> List[dict]:
+    entries = []
+    with open(path) as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError as e:
+                raise SystemExit(f"{path}:{lineno}: {e}")
+            entry['content'] = build_body(entry)
+            entries.append(entry)
+    return entries
+
+
+def build_body(entry: dict) -> bytes:
+    """Request body bytes for a corpus entry"""
+    if 'body' in entry:
+        return entry['body'].encode('utf-8')
+    fill = entry.get('body_fill')
+    if not fill:
+        return b''
+    unit = fill['text'].encode('utf-8')
+    size = int(fill['size'])
+    data = (unit * (size // len(unit) + 1))[:size]
+    part_type = fill.get('multipart')
+    if part_type:
+        ctype = entry.get('headers', {}).get('content-type', '')
+        boundary = ctype.split('boundary=', 1)[-1].strip('"').encode()
+        head = (b'--' + boundary + b'\r\nContent-Disposition: form-data; name="title"\r\n\r\nholiday\r\n'
+                b'--' + boundary + b'\r\nContent-Disposition: form-data; name="file"; filename="upload.bin"\r\n'
+                b'Content-Type: ' + part_type.encode() + b'\r\n\r\n')
+        data = head + data + b'\r\n--' + boundary + b'--\r\n'
+    return data
+
+
+def make_flow(entry: dict, client_ip: str):
+    from mitmproxy import http
+    from mitmproxy.test import tflow
+
+    flow = tflow.tflow(resp=True)
+    host = entry.get('host', 'www.example.com')
+    request = http.Request.make(
+        entry.get('method', 'GET'), f"https://{host}{entry.get('path', '/')}",
+        entry['content'], entry.get('headers', {}))
+    request.timestamp_start = time.time()
+    flow.request = request
+    flow.client_conn.peername = (client_ip, 40000 + len(entry['name']))
+    return flow
+
+
+def percentile(samples: List[int], pct: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index] / 1000.0
+
+
+class Timers:
+    """Wraps instance methods to accumulate call counts and time"""
+
+    def __init__(self):
+        self.calls: Dict[str, int] = {}
+        self.total_ns: Dict[str, int] = {}
+
+    def wrap(self, obj, names, prefix: str):
+        for name in names:
+            method = getattr(obj, name, None)
+            if method is None:
+                continue
+            setattr(obj, name, self._timed(f"{prefix}.{name.lstrip('_')}", method))
+
+    def _timed(self, key: str, method):
+        calls, total = self.calls, self.total_ns
+        calls[key] = 0
+        total[key] = 0
+        clock = time.perf_counter_ns
+
+        def timed(*args, **kwargs):
+            start = clock()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                total[key] += clock() - start
+                calls[key] += 1
+        return timed
+
+    def report(self) -> dict:
+        return {
+            key: {
+                'calls': self.calls[key],
+                'total_ms': round(self.total_ns[key] / 1e6, 3),
+                'mean_us': round(self.total_ns[key] / self.calls[key] / 1000.0, 2) if self.calls[key] else 0.0,
+            }
+            for key in sorted(self.calls)
+        }
+
+
+def latency_report(samples: List[int], elapsed_ns: int) -> dict:
+    return {
+        'requests': len(samples),
+        'rps': round(len(samples) / (elapsed_ns / 1e9), 1) if elapsed_ns else 0.0,
+        'p50_us': round(percentile(samples, 50), 1),
+        'p99_us': round(percentile(samples, 99), 1),
+        'max_us': round(max(samples) / 1000.0, 1) if samples else 0.0,
+    }
+
+
+def setup_addons(scratch: str):
+    """Import both addons with their files redirected into scratch"""
+    for path in (ANALYTICS_DIR, DPI_DIR):
+        path = os.path.normpath(path)
+        if path not in sys.path:
+            sys.path.insert(0, path)
+
+    import waf_cache
+    waf_cache.CACHE_DIR = os.path.join(scratch, 'waf-cache')
+    import waf_loader
+    waf_loader.WAF_RULES_FILE = os.path.normpath(WAF_RULES)
+    waf_loader.WAF_CONFIG_FILE = os.path.join(scratch, 'waf-config.json')
+    import secubox_analytics
+    import dpi_buffer
+
+    # Importing does not build the addon (secubox_analytics.addons is made
+    # on first access), so nothing has touched the real paths yet
+    for const, name in ANALYTICS_PATHS.items():
+        setattr(secubox_analytics, const, os.path.join(scratch, name))
+    analytics = secubox_analytics.SecuBoxAnalytics()
+
+    dpi_buffer.BUFFER_DIR = os.path.join(scratch, 'dpi-buffer')
+    dpi_buffer.STATS_DIR = scratch
+    dpi_buffer.REPUTATION_FILE = os.path.join(scratch, 'ip-reputation.db')
+    dpi_buffer.AUTOBAN_CONFIG = os.path.join(scratch, 'autoban.json')
+    dpi = dpi_buffer.DPIBuffer()
+    return analytics, dpi
+
+
+def measure_startup(scratch: str) -> dict:
+    """SecuBoxAnalytics() construction time with an empty and a filled rule cache"""
+    import secubox_analytics
+    import waf_cache
+    cold, warm = [], []
+    for _ in range(STARTUP_RUNS):
+        shutil.rmtree(waf_cache.CACHE_DIR, ignore_errors=True)
+        for samples in (cold, warm):
+            # The re module cache would hide the compile cost of the second run
+            re.purge()
+            start = time.perf_counter_ns()
+            addon = secubox_analytics.SecuBoxAnalytics()
+            samples.append(time.perf_counter_ns() - start)
+            addon.log_writer.close()
+    return {'cold_ms': round(min(cold) / 1e6, 1), 'cached_ms': round(min(warm) / 1e6, 1)}
+
+
+def schedule(corpus: List[dict], iterations: int) -> List[tuple]:
+    """Deterministic replay order: weighted entries interleaved per iteration"""
+    order = []
+    client = 0
+    for _ in range(iterations):
+        for entry in corpus:
+            for _ in range(int(entry.get('weight', 1))):
+                ip = entry.get('client_ip') or f"198.51.100.{client % CLIENT_POOL + 1}"
+                client += 1
+                order.append((entry, ip))
+    return order
+
+
+def detection_name(flow) -> Optional[str]:
+    entry = flow.metadata.get('secubox_entry') or {}
+    scan = entry.get('scan') or {}
+    if scan.get('is_scan'):
+        return f"{scan.get('category')}:{str(scan.get('pattern'))[:60]}"
+    behavior = entry.get('bot_behavior') or {}
+    if behavior.get('is_bot_behavior'):
+        return f"bot_behavior:{behavior.get('behavior_type')}"
+    return None
+
+
+async def replay(analytics, dpi, order: List[tuple], timers: Optional[Timers]) -> dict:
+    clock = time.perf_counter_ns
+    samples: Dict[str, List[int]] = {'analytics': [], 'dpi_buffer': []}
+    by_kind: Dict[str, List[int]] = {}
+    elapsed = {'analytics': 0, 'dpi_buffer': 0}
+    detections: Dict[str, str] = {}
+    dpi_scores: Dict[str, int] = {}
+
+    for entry, ip in order:
+        flow = make_flow(entry, ip)
+
+        start = clock()
+        pending = analytics.request(flow)
+        if pending is not None:
+            # Body scanned by an offload worker
+            await pending
+        if flow.response is not None:
+            analytics.response(flow)
+        spent = clock() - start
+        samples['analytics'].append(spent)
+        by_kind.setdefault(entry.get('kind', 'other'), []).append(spent)
+        elapsed['analytics'] += spent
+        detections.setdefault(entry['name'], detection_name(flow) or '-')
+
+        flow = make_flow(entry, ip)
+        start = clock()
+        dpi.request(flow)
+        dpi.response(flow)
+        spent = clock() - start
+        samples['dpi_buffer'].append(spent)
+        elapsed['dpi_buffer'] += spent
+        if dpi.buffer:
+            dpi_scores.setdefault(entry['name'], dpi.buffer[-1].get('threat_score', 0))
+
+        # Let the async DPI analysis of this request run outside the timed section
+        await asyncio.sleep(0)
+
+    result = {
+        'analytics': latency_report(samples['analytics'], elapsed['analytics']),
+        'dpi_buffer': latency_report(samples['dpi_buffer'], elapsed['dpi_buffer']),
+        'by_kind': {kind: latency_report(s, sum(s)) for kind, s in sorted(by_kind.items())},
+        'detections': dict(sorted(detections.items())),
+        'dpi_scores': dict(sorted(dpi_scores.items())),
+    }
+    if timers is not None:
+        result['stages'] = timers.report()
+    return result
+
+
+async def run(args) -> dict:
+    from mitmproxy.test import taddons
+
+    corpus = load_corpus(args.corpus)
+    order = schedule(corpus, args.iterations)
+    scratch = tempfile.mkdtemp(prefix='secubox-bench-')
+
+    with taddons.context() as tctx:
+        analytics, dpi = setup_addons(scratch)
+        if args.no_verdict_cache:
+            # Every replayed request scanned in full, as on first sight
+            analytics.verdict_cache.capacity = 0
+            analytics.behavior_cache.capacity = 0
+        tctx.master.addons.add(analytics)
+        tctx.master.addons.add(dpi)
+        startup = measure_startup(scratch)
+
+        # Warm-up pass: lazy caches, first-time imports
+        await replay(analytics, dpi, schedule(corpus, 1), None)
+        if args.adaptive_order:
+            # Order the rule tiers by what the warm-up pass observed
+            analytics.adaptive_order = True
+            analytics._write_rule_stats()
+        if args.offload_workers:
+            analytics.offload.workers = args.offload_workers
+
+        timers = Timers()
+        timers.wrap(analytics, ANALYTICS_STAGES, 'analytics')
+        timers.wrap(dpi, DPI_STAGES, 'dpi_buffer')
+        result = await replay(analytics, dpi, order, timers)
+
+        # Separate pass for allocation tracking - tracemalloc slows every allocation
+        tracemalloc.start()
+        await replay(analytics, dpi, schedule(corpus, 1), None)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        analytics.offload.retire()
+        analytics.log_writer.close()
+
+    result['startup'] = startup
+    result['memory'] = {
+        'traced_peak_kb': peak // 1024,
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    result['meta'] = {
+        'corpus': os.path.basename(args.corpus),
+        'corpus_entries': len(corpus),
+        'iterations': args.iterations,
+        'adaptive_order': args.adaptive_order,
+        'offload_workers': args.offload_workers,
+        'verdict_cache': not args.no_verdict_cache,
+        'python': platform.python_version(),
+        'mitmproxy': mitmproxy_version(),
+        'commit': git_commit(),
+    }
+    return result
+
+
+def mitmproxy_version() -> str:
+    try:
+        from mitmproxy import version
+        return version.VERSION
+    except Exception:
+        return 'unknown'
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE,
+                              capture_output=True, text=True, timeout=5).stdout.strip() or 'unknown'
+    except Exception:
+        return 'unknown'
+
+
+def flatten(data, prefix: str = '') -> Dict[str, object]:
+    out: Dict[str, object] = {}
+    if isinstance(data, dict):
+        for key, value in data.items():
+            out.update(flatten(value, f"{prefix}.{key}" if prefix else key))
+    else:
+        out[prefix] = data
+    return out
+
+
+def compare(previous: dict, current: dict):
+    """Print numeric deltas and changed detections between two runs"""
+    old, new = flatten(previous), flatten(current)
+    print(f"{'metric':58} {'before':>12} {'after':>12} {'change':>9}")
+    for key in sorted(set(old) | set(new)):
+        if key.startswith('meta.'):
+            continue
+        a, b = old.get(key), new.get(key)
+        if isinstance(a, (int, float)) and isinstance(b, (int, float)):
+            if key.startswith(('detections.', 'dpi_scores.')) and a == b:
+                continue
+            change = f"{(b - a) / a * 100:+.1f}%" if a else ''
+            print(f"{key:58} {a:>12} {b:>12} {change:>9}")
+        elif a != b:
+            print(f"{key:58} {str(a)[:12]:>12} {str(b)[:12]:>12}")
+
+
+def summary(result: dict):
+    for addon in ('analytics', 'dpi_buffer'):
+        r = result[addon]
+        print(f"{addon:12} {r['requests']:7d} req  {r['rps']:10.1f} req/s  "
+              f"p50 {r['p50_us']:9.1f} us  p99 {r['p99_us']:10.1f} us  max {r['max_us']:10.1f} us")
+    for kind, r in result['by_kind'].items():
+        print(f"  {kind:10} {r['requests']:7d} req  p50 {r['p50_us']:9.1f} us  p99 {r['p99_us']:10.1f} us")
+    print('stages (inclusive):')
+    for key, r in result['stages'].items():
+        print(f"  {key:40} {r['calls']:7d} calls  {r['total_ms']:10.1f} ms  {r['mean_us']:9.1f} us/call")
+    st = result['startup']
+    print(f"startup: {st['cold_ms']} ms cold, {st['cached_ms']} ms with the rule cache")
+    m = result['memory']
+    print(f"memory: traced peak {m['traced_peak_kb']} KiB, max RSS {m['max_rss_kb']} KiB")
+    detected = sum(1 for v in result['detections'].values() if v != '-')
+    print(f"detections: {detected}/{len(result['detections'])} corpus entries flagged")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SecuBox WAF detection benchmark')
+    parser.add_argument('--corpus', default=DEFAULT_CORPUS, help='request corpus (JSONL)')
+    parser.add_argument('--iterations', type=int, default=20, help='passes over the corpus')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--compare', help='previous results JSON to compare against')
+    parser.add_argument('--adaptive-order', action='store_true',
+                        help='reorder rule tiers by hit rate and cost after the warm-up pass')
+    parser.add_argument('--offload-workers', type=int, default=0,
+                        help='scan large bodies in this many worker processes after the warm-up pass')
+    parser.add_argument('--no-verdict-cache', action='store_true',
+                        help='do not memoize detection verdicts (the corpus repeats every request)')
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    summary(result)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+            f.write('\n')
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        print()
+        compare(previous, result)
+
+
+if __name__ == '__main__':
+    main()
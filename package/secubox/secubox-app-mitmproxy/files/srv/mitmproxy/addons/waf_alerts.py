@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+SecuBox WAF Alert Ring
+Most recent security alerts of the analytics addon, kept in a fixed-size
+ring and written to the alerts file at most once per flush interval
+During an attack a single request can raise several alerts; writing the
+file for each one made the file write the most expensive part of the
+request. Every alert carries a sequence number so that readers of the file
+can pick up only what they have not seen
+"""
+
+import asyncio
+import json
+import os
+import time
+from collections import deque
+from typing import Deque, List, Optional
+
+
+class AlertRing:
+    """
+    Last capacity alerts, flushed (temp file + rename) debounced.
+
+    The first alert after a quiet period is written at once; alerts within
+    flush_ms of the last write are written together when the interval
+    ends (a timer on the running event loop; without a loop, by the next
+    add() past the interval or by close()). The file stays a JSON array,
+    oldest first; seq increases by one per alert and continues from the
+    file across addon restarts.
+    """
+
+    def __init__(self, path: str, capacity: int = 100, flush_ms: float = 1000.0):
+        self.path = path
+        self.flush_ms = flush_ms
+        self.alerts: Deque[dict] = deque(maxlen=capacity)
+        self.seq = 0
+        self.added = 0
+        self.writes = 0
+        self.errors = 0
+        self.last_error: Optional[str] = None
+        self._dirty = False
+        self._scheduled = False
+        self._flushed_at = 0.0
+
+    @property
+    def capacity(self) -> int:
+        return self.alerts.maxlen
+
+    @capacity.setter
+    def capacity(self, capacity: int):
+        if capacity != self.alerts.maxlen:
+            self.alerts = deque(self.alerts, maxlen=max(capacity, 1))
+
+    def load(self):
+        """Take over the alerts (and the sequence) of a previous run"""
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            self._error(f"Error reading {self.path}: {e}")
+            return
+        if isinstance(data, list):
+            self.alerts.extend(a for a in data if isinstance(a, dict))
+            self.seq = max((a.get('seq', 0) for a in self.alerts if isinstance(a.get('seq'), int)), default=0)
+
+    def add(self, alert: dict) -> int:
+        """Append an alert (its seq field is set) and schedule a write"""
+        self.seq += 1
+        alert['seq'] = self.seq
+        self.alerts.append(alert)
+        self.added += 1
+        self._dirty = True
+        wait = self.flush_ms / 1000.0 - (time.monotonic() - self._flushed_at)
+        if wait <= 0:
+            self.flush()
+        elif not self._scheduled:
+            try:
+                asyncio.get_running_loop().call_later(wait, self._timer)
+                self._scheduled = True
+            except RuntimeError:
+                pass
+        return self.seq
+
+    def since(self, seq: int) -> List[dict]:
+        """Alerts newer than seq, oldest first"""
+        return [a for a in self.alerts if a.get('seq', 0) > seq]
+
+    def _timer(self):
+        self._scheduled = False
+        self.flush()
+
+    def flush(self):
+        """Write the ring if it changed since the last write"""
+        if not self._dirty:
+            return
+        self._dirty = False
+        self._flushed_at = time.monotonic()
+        tmp = f"{self.path}.tmp"
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(list(self.alerts), f)
+            os.replace(tmp, self.path)
+            self.writes += 1
+        except (OSError, TypeError, ValueError) as e:
+            self._error(f"Error writing {self.path}: {e}")
+
+    def close(self):
+        self.flush()
+
+    def _error(self, message: str):
+        self.errors += 1
+        self.last_error = message
+
+    def stats(self) -> dict:
+        """Ring counters for the stats file"""
+        return {
+            'capacity': self.capacity,
+            'entries': len(self.alerts),
+            'seq': self.seq,
+            'added': self.added,
+            'writes': self.writes,
+            'errors': self.errors,
+            'last_error': self.last_error,
+        }
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+SecuBox WAF Auto-ban Configuration
+autoban.json, written by the host from UCI (mitmproxyctl reload-autoban),
+is watched by mtime and picked up without restarting the addon, and its
+whitelist is parsed once into a set of networks that answers membership
+with a binary search instead of splitting and scanning a string for every
+ban decision
+"""
+
+import ipaddress
+import json
+import os
+import socket
+import time
+from bisect import bisect_right
+from typing import Iterable, List, Optional, Tuple, Union
+
+# Settings used when the host has not written autoban.json
+AUTOBAN_DEFAULTS = {
+    'enabled': False,
+    'ban_duration': '4h',
+    'min_severity': 'critical',
+    'ban_cve_exploits': True,
+    'ban_sqli': True,
+    'ban_cmdi': True,
+    'ban_traversal': True,
+    'ban_scanners': True,
+    'ban_rate_limit': False,
+    'whitelist': [],
+    # Sensitivity levels
+    'sensitivity': 'moderate',
+    'moderate_threshold': 3,
+    'moderate_window': 300,
+    'permissive_threshold': 5,
+    'permissive_window': 3600,
+}
+
+
+class NetworkSet:
+    """
+    IPv4/IPv6 addresses and CIDR networks, merged into sorted disjoint
+    ranges per family; `ip in netset` is O(log n). Entries that are not
+    an address or a network are kept in invalid.
+    """
+
+    def __init__(self, entries: Iterable[str] = ()):
+        self.entries: List[str] = []
+        self.invalid: List[str] = []
+        ranges = {4: [], 6: []}
+        for entry in entries:
+            entry = entry.strip()
+            if not entry:
+                continue
+            try:
+                net = ipaddress.ip_network(entry, strict=False)
+            except ValueError:
+                self.invalid.append(entry)
+                continue
+            self.entries.append(entry)
+            ranges[net.version].append((int(net.network_address), int(net.broadcast_address)))
+        self._starts = {}
+        self._ends = {}
+        for version, spans in ranges.items():
+            merged: List[Tuple[int, int]] = []
+            for start, end in sorted(spans):
+                if merged and start <= merged[-1][1] + 1:
+                    merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+                else:
+                    merged.append((start, end))
+            self._starts[version] = [s for s, _ in merged]
+            self._ends[version] = [e for _, e in merged]
+
+    @classmethod
+    def parse(cls, value: Union[str, Iterable[str], None]) -> 'NetworkSet':
+        """From a comma/space separated string (UCI) or a list"""
+        if isinstance(value, str):
+            value = value.replace(',', ' ').split()
+        return cls(value or ())
+
+    def __contains__(self, ip: str) -> bool:
+        # inet_pton is several times faster than ipaddress.ip_address()
+        try:
+            value, version = int.from_bytes(socket.inet_pton(socket.AF_INET, ip), 'big'), 4
+        except (OSError, TypeError):
+            try:
+                value, version = int.from_bytes(socket.inet_pton(socket.AF_INET6, ip.split('%')[0]), 'big'), 6
+            except (OSError, TypeError, AttributeError):
+                return False
+            if value >> 32 == 0xffff:
+                # IPv4-mapped (::ffff:a.b.c.d)
+                value, version = value & 0xffffffff, 4
+        i = bisect_right(self._starts[version], value) - 1
+        return i >= 0 and value <= self._ends[version][i]
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+def _file_signature(path: str) -> Optional[Tuple[int, int, int]]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+class AutobanConfigWatcher:
+    """
+    autoban.json with an mtime check every reload_interval seconds.
+
+    load() reads the file (AUTOBAN_DEFAULTS when it does not exist) and
+    returns None when it cannot be parsed; the caller keeps the settings it
+    has, and the file is read again on the next check. poll() is cheap
+    enough for every request: between checks it is a clock comparison.
+    """
+
+    def __init__(self, path: str, reload_interval: float = 2.0):
+        self.path = path
+        # Seconds between mtime checks in poll() (0 = no hot reload)
+        self.reload_interval = reload_interval
+        self.reloads = 0
+        self.error: Optional[str] = None
+        self._signature = None
+        self._next_check = 0.0
+        self._reported: Optional[str] = None
+
+    def load(self) -> Optional[dict]:
+        """Current settings of the file, or None (error set) if it does not parse"""
+        signature = _file_signature(self.path)
+        if signature is None:
+            self._signature = None
+            self.error = self._reported = None
+            return dict(AUTOBAN_DEFAULTS)
+        try:
+            with open(self.path, 'r') as f:
+                config = json.load(f)
+            if not isinstance(config, dict):
+                raise ValueError('not a JSON object')
+        except (OSError, ValueError) as e:
+            # Possibly caught mid-write: retried at the next check
+            self._signature = None
+            self.error = f"{self.path}: {e}"
+            return None
+        self._signature = signature
+        self.error = self._reported = None
+        return config
+
+    def take_error(self) -> Optional[str]:
+        """The load error, once per distinct message"""
+        if self.error is None or self.error == self._reported:
+            return None
+        self._reported = self.error
+        return self.error
+
+    def poll(self, now: Optional[float] = None) -> Optional[dict]:
+        """New settings if the file changed since it was last loaded"""
+        if self.reload_interval <= 0:
+            return None
+        now = time.monotonic() if now is None else now
+        if now < self._next_check:
+            return None
+        self._next_check = now + self.reload_interval
+        if _file_signature(self.path) == self._signature and self.error is None:
+            return None
+        config = self.load()
+        if config is not None:
+            self.reloads += 1
+        return config
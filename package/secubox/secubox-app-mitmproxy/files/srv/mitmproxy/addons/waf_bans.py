@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""
+SecuBox WAF Ban Dispatcher
+Pushes auto-ban decisions straight to the CrowdSec local API (LAPI)
+The request file read by the host cron job (mitmproxyctl process-autoban)
+takes up to a minute and one cscli call per IP to turn into a ban, while
+the attacker keeps going. BanDispatcher queues the bans, sends them in
+batches as LAPI alerts from a background task, retries with exponential
+backoff and falls back to the request file when the API cannot be
+reached, so the cron job still picks up whatever did not go through
+"""
+
+import asyncio
+import http.client
+import json
+import socket
+import time
+from collections import deque
+from datetime import datetime
+from typing import Deque, List, Optional
+from urllib.parse import urlsplit
+
+# Decision origin; the one `cscli decisions add` (the cron path) uses, so
+# bouncers and `cscli decisions list` treat both paths alike
+ORIGIN = 'cscli'
+# Latency samples kept for the percentiles of the stats file
+LATENCY_SAMPLES = 256
+
+
+class BanPushError(Exception):
+    """A batch the API did not take; retry tells whether trying again may help"""
+
+    def __init__(self, message: str, retry: bool = True):
+        super().__init__(message)
+        self.retry = retry
+
+
+class _UnixConnection(http.client.HTTPConnection):
+    """HTTP over a unix socket (a local relay in front of the LAPI)"""
+
+    def __init__(self, path: str, timeout: float):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+
+
+def _alert(ban: dict, machine: str) -> dict:
+    """LAPI alert carrying the ban decision of one IP (as cscli builds it)"""
+    now = datetime.utcnow().isoformat() + 'Z'
+    reason = f"mitmproxy-waf: {ban.get('reason', '')}"
+    return {
+        'scenario': reason,
+        'scenario_hash': '',
+        'scenario_version': '',
+        'message': f"{ban.get('severity', 'high')} threat from {ban['ip']} ({machine})",
+        'events_count': 1,
+        'events': [],
+        'start_at': now,
+        'stop_at': now,
+        'capacity': 0,
+        'leakspeed': '0',
+        'simulated': False,
+        'remediation': True,
+        'source': {'scope': 'Ip', 'value': ban['ip']},
+        'decisions': [{
+            'duration': ban.get('duration', '4h'),
+            'origin': ORIGIN,
+            'scenario': reason,
+            'scope': 'Ip',
+            'type': 'ban',
+            'value': ban['ip'],
+        }],
+    }
+
+
+class BanDispatcher:
+    """
+    Batched ban submission to the CrowdSec LAPI, request file as fallback.
+
+    submit() only queues. The task started by start() waits interval_ms
+    for more bans after the first one and posts up to batch of them in one
+    POST /v1/alerts, authenticated as a CrowdSec machine (the JWT from
+    /v1/watchers/login, renewed on a 401). Connection errors, timeouts and
+    5xx answers are retried retries times, backoff seconds doubling each
+    time up to max_backoff; a batch that still fails, any ban past
+    max_queue, and what is queued when close() is called go to the
+    request file instead. Without a URL and machine credentials (or
+    before start()) every ban goes to the file, as before.
+
+    url is http://host:port, https://host:port or unix:///path/of/socket
+    for a relay that forwards the same HTTP API.
+    """
+
+    def __init__(self, fallback_path: str, batch: int = 50, interval_ms: float = 200.0,
+                 retries: int = 4, backoff: float = 0.5, max_backoff: float = 30.0,
+                 timeout: float = 5.0, max_queue: int = 1000):
+        self.fallback_path = fallback_path
+        self.batch = batch
+        self.interval_ms = interval_ms
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.max_queue = max_queue
+        self.url = ''
+        self.login = ''
+        self.password = ''
+        self.queue: Deque[dict] = deque()
+        self.submitted = 0
+        self.sent = 0
+        self.batches = 0
+        self.retried = 0
+        self.logins = 0
+        self.fallback = 0
+        self.errors = 0
+        self.last_error: Optional[str] = None
+        self.latency_ms: Deque[float] = deque(maxlen=LATENCY_SAMPLES)
+        self.max_latency_ms = 0.0
+        self._token: Optional[str] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._inflight: List[dict] = []
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.url and self.login and self.password)
+
+    def configure(self, url: str, login: str, password: str):
+        """Set the API endpoint and machine credentials (empty url: file only)"""
+        if (url, login, password) != (self.url, self.login, self.password):
+            self.url, self.login, self.password = url, login, password
+            self._token = None
+
+    def start(self):
+        """Start the sender task on the running event loop"""
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def submit(self, ban: dict) -> bool:
+        """Queue a ban for the API; False if it was written to the request file"""
+        self.submitted += 1
+        if not self.enabled or self._task is None or len(self.queue) >= self.max_queue:
+            self._write_fallback([ban])
+            return False
+        self.queue.append({**ban, '_queued': time.monotonic()})
+        self._wakeup.set()
+        return True
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            if len(self.queue) < self.batch:
+                # Let the bans of the same burst join this batch
+                await asyncio.sleep(self.interval_ms / 1000.0)
+            while self.queue:
+                self._inflight = [self.queue.popleft() for _ in range(min(self.batch, len(self.queue)))]
+                await self._send(self._inflight)
+                self._inflight = []
+
+    async def _send(self, batch: List[dict]):
+        loop = asyncio.get_running_loop()
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self.retried += 1
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_backoff)
+            try:
+                await loop.run_in_executor(None, self._push, batch)
+            except BanPushError as e:
+                self._error(str(e))
+                if not e.retry:
+                    break
+                continue
+            except Exception as e:
+                self._error(f"{type(e).__name__}: {e}")
+                break
+            acked = time.monotonic()
+            for ban in batch:
+                latency = (acked - ban['_queued']) * 1000
+                self.latency_ms.append(latency)
+                self.max_latency_ms = max(self.max_latency_ms, latency)
+            self.sent += len(batch)
+            self.batches += 1
+            return
+        self._write_fallback(batch)
+
+    def _push(self, batch: List[dict]):
+        """POST the batch as alerts (runs in an executor thread)"""
+        body = [_alert(ban, self.login) for ban in batch]
+        if self._token is None:
+            self._authenticate()
+        status, answer = self._call('POST', '/v1/alerts', body, self._token)
+        if status == 401:
+            # Token expired: log in again once
+            self._authenticate()
+            status, answer = self._call('POST', '/v1/alerts', body, self._token)
+        if status not in (200, 201):
+            raise BanPushError(f"POST /v1/alerts: HTTP {status} {answer[:200]}",
+                               retry=status >= 500 or status == 429)
+
+    def _authenticate(self):
+        self._token = None
+        status, answer = self._call('POST', '/v1/watchers/login',
+                                    {'machine_id': self.login, 'password': self.password, 'scenarios': []})
+        if status != 200:
+            raise BanPushError(f"LAPI login: HTTP {status} {answer[:200]}", retry=status >= 500)
+        try:
+            self._token = json.loads(answer)['token']
+        except (ValueError, KeyError, TypeError):
+            raise BanPushError(f"LAPI login: unexpected answer {answer[:200]}")
+        self.logins += 1
+
+    def _call(self, method: str, path: str, payload, token: Optional[str] = None) -> tuple:
+        url = urlsplit(self.url)
+        if url.scheme == 'unix':
+            conn = _UnixConnection(url.path, self.timeout)
+        elif url.scheme == 'https':
+            conn = http.client.HTTPSConnection(url.hostname, url.port, timeout=self.timeout)
+        else:
+            conn = http.client.HTTPConnection(url.hostname, url.port, timeout=self.timeout)
+        headers = {'Content-Type': 'application/json', 'User-Agent': 'secubox-waf'}
+        if token:
+            headers['Authorization'] = f"Bearer {token}"
+        # An http(s) URL may carry a path prefix (a reverse proxy)
+        prefix = '' if url.scheme == 'unix' else url.path.rstrip('/')
+        try:
+            conn.request(method, prefix + path, body=json.dumps(payload), headers=headers)
+            response = conn.getresponse()
+            return response.status, response.read().decode('utf-8', 'replace')
+        except (OSError, http.client.HTTPException) as e:
+            raise BanPushError(f"{method} {path}: {type(e).__name__}: {e}")
+        finally:
+            conn.close()
+
+    def _write_fallback(self, bans: List[dict]):
+        """Append bans to the request file of the cron job"""
+        try:
+            with open(self.fallback_path, 'a') as f:
+                for ban in bans:
+                    f.write(json.dumps({k: v for k, v in ban.items() if k != '_queued'}) + '\n')
+            self.fallback += len(bans)
+        except OSError as e:
+            self._error(f"Error writing {self.fallback_path}: {e}")
+
+    def close(self):
+        """Stop the sender; bans not yet accepted go to the request file"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        # A batch cut off mid-send may already be banned; the cron job skips
+        # IPs that have a decision
+        pending = self._inflight + list(self.queue)
+        self._inflight = []
+        self.queue.clear()
+        if pending:
+            self._write_fallback(pending)
+
+    def _error(self, message: str):
+        self.errors += 1
+        self.last_error = message
+
+    def stats(self) -> dict:
+        """Dispatcher counters and ban latency (queued to accepted by the API)"""
+        samples = sorted(self.latency_ms)
+        return {
+            'enabled': self.enabled,
+            'url': self.url,
+            'queued': len(self.queue),
+            'submitted': self.submitted,
+            'sent': self.sent,
+            'batches': self.batches,
+            'retries': self.retried,
+            'logins': self.logins,
+            'fallback': self.fallback,
+            'errors': self.errors,
+            'last_error': self.last_error,
+            'latency_ms': {
+                'p50': round(samples[len(samples) // 2], 1) if samples else 0.0,
+                'p95': round(samples[int(len(samples) * 0.95)], 1) if samples else 0.0,
+                'max': round(self.max_latency_ms, 1),
+            },
+        }
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+SecuBox WAF Rule Cache
+Persists the load-time analysis of the detection rules across restarts
+Every pattern is parsed at startup to extract its prefilter literals and
+classify its backtracking risk, which dominates the addon start on slow
+ARM cores. The normalized result is stored under /data keyed by a content
+hash of the rule sources, so an unchanged rule set skips that work
+"""
+
+import hashlib
+import json
+import os
+import sys
+from typing import Dict, List, Optional, Sequence
+
+import waf_engine
+from waf_engine import Analysis, PatternSet
+
+CACHE_DIR = "/data/waf-cache"
+
+# Bumped when the layout of the cached payloads changes
+CACHE_FORMAT = 1
+
+
+def _engine_fingerprint() -> str:
+    """Hash of the analysis code - a changed waf_engine invalidates every entry"""
+    try:
+        with open(waf_engine.__file__, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return 'unknown'
+
+
+def dump_analysis(sets: Dict[str, PatternSet]) -> Dict[str, List[list]]:
+    """JSON-ready {set name: [[literals, risk], ...]} of compiled PatternSets"""
+    return {name: [[list(lits) if lits else None, risk] for lits, risk in ps.analysis]
+            for name, ps in sets.items()}
+
+
+def load_analysis(payload: Optional[Dict], name: str) -> Optional[List[Analysis]]:
+    """Analysis list of one set from a dump_analysis() payload, or None"""
+    entries = (payload or {}).get(name)
+    if not isinstance(entries, list):
+        return None
+    try:
+        return [(tuple(lits) if lits else None, risk) for lits, risk in entries]
+    except (TypeError, ValueError):
+        return None
+
+
+def analyses(payload: Optional[Dict], names: Sequence[str]) -> Dict[str, Optional[List[Analysis]]]:
+    """load_analysis() for several sets"""
+    return {name: load_analysis(payload, name) for name in names}
+
+
+class RuleCache:
+    """One JSON file per rule source under the cache directory, replaced atomically"""
+
+    def __init__(self, directory: Optional[str] = None, enabled: bool = True):
+        self.directory = directory or CACHE_DIR
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.errors = 0
+        self.last_error: Optional[str] = None
+        self._fingerprint: Optional[str] = None
+
+    def key(self, *sources) -> str:
+        """
+        Content hash of the given rule sources (str or bytes).
+
+        The cache format, the Python version (sre parsing differs between
+        releases) and the engine source are part of the key.
+        """
+        if self._fingerprint is None:
+            self._fingerprint = _engine_fingerprint()
+        digest = hashlib.sha256(f"{CACHE_FORMAT}:{sys.version_info[0]}.{sys.version_info[1]}:"
+                                f"{self._fingerprint}".encode())
+        for source in sources:
+            data = source.encode('utf-8') if isinstance(source, str) else (source or b'')
+            digest.update(len(data).to_bytes(8, 'big'))
+            digest.update(data)
+        return digest.hexdigest()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, f"{name}.json")
+
+    def load(self, name: str, key: str) -> Optional[Dict]:
+        """Payload stored for name under key; None when absent, stale or unreadable"""
+        if not self.enabled:
+            return None
+        try:
+            with open(self._path(name), 'r') as f:
+                entry = json.load(f)
+            if entry.get('format') == CACHE_FORMAT and entry.get('key') == key:
+                self.hits += 1
+                return entry.get('payload')
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, AttributeError) as e:
+            self._error(f"Error reading {self._path(name)}: {e}")
+        self.misses += 1
+        return None
+
+    def store(self, name: str, key: str, payload: Dict) -> bool:
+        """Write the payload for name, replacing any older entry"""
+        if not self.enabled:
+            return False
+        path = self._path(name)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmp, 'w') as f:
+                json.dump({'format': CACHE_FORMAT, 'key': key, 'payload': payload}, f, separators=(',', ':'))
+            os.replace(tmp, path)
+            self.writes += 1
+            return True
+        except (OSError, TypeError, ValueError) as e:
+            self._error(f"Error writing {path}: {e}")
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            return False
+
+    def _error(self, message: str):
+        self.errors += 1
+        self.last_error = message
+
+    def stats(self) -> dict:
+        """Cache counters for the stats file"""
+        return {
+            'enabled': self.enabled,
+            'directory': self.directory,
+            'hits': self.hits,
+            'misses': self.misses,
+            'writes': self.writes,
+            'errors': self.errors,
+            'last_error': self.last_error,
+        }
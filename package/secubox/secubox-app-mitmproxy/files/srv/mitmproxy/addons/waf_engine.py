@@ -0,0 +1,901 @@
+#!/usr/bin/env python3
+"""
+SecuBox WAF Detection Engine
+Precompiled multi-pattern matching for the analytics addon
+Each pattern category is compiled once at addon load instead of going
+through the re module cache (which holds 512 entries) on every request
+A literal prefilter skips every regex whose mandatory literal is absent
+Rules prone to catastrophic backtracking are flagged at load time and run
+on a linear-time engine (re2, or a built-in NFA) over a bounded window
+"""
+
+import re
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+try:
+    from re import _parser as sre_parse  # Python 3.11+
+except ImportError:
+    import sre_parse
+
+try:
+    import re2  # google-re2 / pyre2 - linear-time matching, optional
+except ImportError:
+    re2 = None
+
+# Shortest literal worth filtering on - shorter ones match nearly everything
+MIN_LITERAL_LENGTH = 2
+
+# Non-ASCII characters that re.IGNORECASE treats as equal to an ASCII letter.
+# They are mapped before lowercasing so the prefilter never rejects a text
+# the regex itself would match
+_CASE_FIXES = str.maketrans({'\u0130': 'i', '\u0131': 'i', '\u212a': 'k', '\u017f': 's'})
+
+
+def fold_text(text: str) -> str:
+    """Lowercase text the way the prefilter literals are stored"""
+    if not text.isascii():
+        text = text.translate(_CASE_FIXES)
+    return text.lower()
+
+
+def _literal_char(op, av) -> Optional[str]:
+    """Return the lowercased ASCII character matched by a parsed item, if fixed"""
+    if op is sre_parse.LITERAL:
+        c = chr(av)
+        return c.lower() if c.isascii() else None
+    if op is sre_parse.IN:
+        # [Ss] or (?:S|s) - a single letter in both cases
+        chars = {_literal_char(o, a) for o, a in av}
+        if len(chars) == 1 and None not in chars:
+            return chars.pop()
+    return None
+
+
+def _requirements(items) -> List[Tuple[str, ...]]:
+    """
+    Collect the literal requirements of a parsed sequence.
+
+    Each requirement is a tuple of literals of which at least one must appear
+    in any text the sequence matches.
+    """
+    found = []
+    run = []
+
+    def end_run():
+        if run:
+            found.append((''.join(run),))
+            run.clear()
+
+    for op, av in items:
+        c = _literal_char(op, av)
+        if c is not None:
+            run.append(c)
+            continue
+        end_run()
+        if op is sre_parse.SUBPATTERN:
+            found.append(_best(_requirements(av[-1])))
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and av[0] >= 1:
+            found.append(_best(_requirements(av[2])))
+        elif op is sre_parse.BRANCH:
+            alternatives = [_best(_requirements(branch)) for branch in av[1]]
+            if all(alternatives):
+                found.append(tuple(lit for alt in alternatives for lit in alt))
+    end_run()
+    return [req for req in found if req]
+
+
+def _best(requirements: List[Tuple[str, ...]]) -> Optional[Tuple[str, ...]]:
+    """Pick the most selective requirement: longest shortest-literal, fewest alternatives"""
+    usable = [req for req in requirements if min(len(lit) for lit in req) >= MIN_LITERAL_LENGTH]
+    if not usable:
+        return None
+    return max(usable, key=lambda req: (min(len(lit) for lit in req), -len(req)))
+
+
+def extract_literals(pattern: str, flags: int = re.IGNORECASE) -> Optional[Tuple[str, ...]]:
+    """
+    Return the literals (folded) of which one must appear for pattern to match.
+
+    Returns None when the pattern has no usable mandatory literal; such a
+    pattern is always evaluated.
+    """
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+    except Exception:
+        return None
+    return _best(_requirements(parsed.data if hasattr(parsed, 'data') else parsed))
+
+
+def _is_wide(op, av) -> bool:
+    """True for atoms matching almost any character (., [^x], negated classes)"""
+    if op in (sre_parse.ANY, sre_parse.NOT_LITERAL):
+        return True
+    return op is sre_parse.IN and bool(av) and av[0][0] is sre_parse.NEGATE
+
+
+def _risks(items, in_repeat: bool, followed: bool, state: dict, out: List[str]):
+    """Walk a parsed sequence collecting backtracking hazards"""
+    last = len(items) - 1
+    for j, (op, av) in enumerate(items):
+        more = followed or j < last
+        if op is sre_parse.GROUPREF:
+            out.append('backreference')
+        elif op is sre_parse.SUBPATTERN:
+            _risks(av[-1], in_repeat, more, state, out)
+        elif op is sre_parse.BRANCH:
+            for branch in av[1]:
+                _risks(branch, in_repeat, more, state, out)
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+            unbounded = av[1] is sre_parse.MAXREPEAT
+            body = list(av[2])
+            if unbounded and in_repeat:
+                out.append('nested quantifier')
+            elif unbounded and state.get('wildcard'):
+                # .+\s+from or .*{.*{ - every split point is retried
+                out.append('overlapping quantifiers')
+            if unbounded and more and len(body) == 1 and _is_wide(*body[0]):
+                out.append('unbounded wildcard')
+                state['wildcard'] = True
+            _risks(body, in_repeat or unbounded, more, state, out)
+
+
+# Hazards whose cost grows faster than quadratically with the input length
+CATASTROPHIC = ('backreference', 'nested quantifier', 'overlapping quantifiers')
+
+
+def redos_risk(pattern: str, flags: int = re.IGNORECASE) -> Optional[str]:
+    """
+    Return why pattern may backtrack super-linearly in sre, or None.
+
+    An unbounded wildcard (.*, .+, [^x]+) followed by more pattern makes a
+    search quadratic in the input length; nested or overlapping unbounded
+    quantifiers and backreferences make it worse (see CATASTROPHIC).
+    """
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+    except Exception:
+        return None
+    found: List[str] = []
+    _risks(list(parsed), False, False, {}, found)
+    return ', '.join(sorted(set(found))) if found else None
+
+
+# Load-time analysis of one pattern: (prefilter literals, ReDoS risk)
+Analysis = Tuple[Optional[Tuple[str, ...]], Optional[str]]
+
+
+def analyze_pattern(pattern: str, flags: int = re.IGNORECASE) -> Analysis:
+    """extract_literals() and redos_risk() of pattern from a single parse"""
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+    except Exception:
+        return None, None
+    items = list(parsed)
+    found: List[str] = []
+    _risks(items, False, False, {}, found)
+    return _best(_requirements(items)), (', '.join(sorted(set(found))) if found else None)
+
+
+def is_catastrophic(reason: Optional[str]) -> bool:
+    """True when a redos_risk() reason is worse than quadratic"""
+    return bool(reason) and any(r in reason for r in CATASTROPHIC)
+
+
+# Thompson NFA instructions used by LinearMatcher
+_CHAR, _SPLIT, _JMP, _ASSERT, _MATCH = range(5)
+
+# Counted repeats are unrolled; larger counts are left to sre
+_MAX_UNROLL = 64
+
+
+def _is_word(c: str) -> bool:
+    return c.isalnum() or c == '_'
+
+
+_CATEGORIES = {
+    sre_parse.CATEGORY_DIGIT: str.isdecimal,
+    sre_parse.CATEGORY_NOT_DIGIT: lambda c: not c.isdecimal(),
+    sre_parse.CATEGORY_SPACE: str.isspace,
+    sre_parse.CATEGORY_NOT_SPACE: lambda c: not c.isspace(),
+    sre_parse.CATEGORY_WORD: _is_word,
+    sre_parse.CATEGORY_NOT_WORD: lambda c: not _is_word(c),
+}
+
+
+class LinearMatcher:
+    """
+    Backtracking-free search for the sre syntax subset used by the WAF rules.
+
+    The pattern is compiled to a Thompson NFA and simulated one character at
+    a time, so a search costs O(len(text) * states) whatever the input. Used
+    for CATASTROPHIC rules when re2 is not installed. Raises ValueError for
+    constructs an NFA cannot express (backreferences, lookarounds, atomic
+    groups) so the caller can keep sre for those.
+    """
+
+    # Cached DFA transitions per rule before the cache is reset
+    DFA_CACHE_SIZE = 4096
+
+    def __init__(self, pattern: str, flags: int = re.IGNORECASE):
+        if flags & (re.MULTILINE | re.VERBOSE):
+            raise ValueError('unsupported flags')
+        parsed = sre_parse.parse(pattern, flags)
+        self.pattern = pattern
+        self.ignorecase = bool(flags & re.IGNORECASE)
+        self.dotall = bool(parsed.state.flags & re.DOTALL)
+        self.ops: List[list] = []
+        items = list(parsed)
+        self._emit_seq(items)
+        self.ops.append([_MATCH, None, None])
+        # Literal prefix - lets the search jump with str.find while idle
+        prefix = []
+        for op, av in items:
+            if op is not sre_parse.LITERAL:
+                break
+            prefix.append(self._fold(chr(av)))
+        self.prefix = ''.join(prefix)
+        self.closures = [self._static_closure(pc) for pc in range(len(self.ops))]
+        # Without assertions the NFA state sets are cached as DFA transitions
+        self.dfa: Optional[Dict[Tuple[Tuple[int, ...], str], Tuple[Tuple[int, ...], bool]]] = None
+        if all(closure is not None for closure in self.closures):
+            self.dfa = {}
+
+    def _fold(self, c: str) -> str:
+        return fold_text(c) if self.ignorecase else c
+
+    def _emit(self, kind, a=None, b=None) -> int:
+        self.ops.append([kind, a, b])
+        return len(self.ops) - 1
+
+    def _char_class(self, items) -> Callable[[str], bool]:
+        negate = False
+        chars = set()
+        ranges = []
+        tests = []
+        for op, av in items:
+            if op is sre_parse.NEGATE:
+                negate = True
+            elif op is sre_parse.LITERAL:
+                chars.add(self._fold(chr(av)))
+            elif op is sre_parse.RANGE:
+                ranges.append(av)
+            elif op is sre_parse.CATEGORY and av in _CATEGORIES:
+                tests.append(_CATEGORIES[av])
+            else:
+                raise ValueError(f'unsupported class item {op}')
+        ignorecase = self.ignorecase
+
+        def member(c: str) -> bool:
+            if c in chars or any(t(c) for t in tests):
+                return True
+            for lo, hi in ranges:
+                if lo <= ord(c) <= hi:
+                    return True
+                if ignorecase:
+                    u = c.upper()
+                    if len(u) == 1 and lo <= ord(u) <= hi:
+                        return True
+            return False
+
+        return (lambda c: not member(c)) if negate else member
+
+    def _emit_seq(self, items):
+        for op, av in items:
+            self._emit_item(op, av)
+
+    def _emit_item(self, op, av):
+        if op is sre_parse.LITERAL:
+            ch = self._fold(chr(av))
+            self._emit(_CHAR, ch.__eq__)
+        elif op is sre_parse.NOT_LITERAL:
+            ch = self._fold(chr(av))
+            self._emit(_CHAR, ch.__ne__)
+        elif op is sre_parse.ANY:
+            self._emit(_CHAR, (lambda c: True) if self.dotall else '\n'.__ne__)
+        elif op is sre_parse.IN:
+            self._emit(_CHAR, self._char_class(av))
+        elif op is sre_parse.SUBPATTERN:
+            _group, add_flags, del_flags, body = av
+            if (add_flags | del_flags) & (re.IGNORECASE | re.MULTILINE | re.DOTALL):
+                raise ValueError('inline flag group')
+            self._emit_seq(body)
+        elif op is sre_parse.BRANCH:
+            branches = av[1]
+            jumps = []
+            for k, branch in enumerate(branches):
+                split = None
+                if k < len(branches) - 1:
+                    split = self._emit(_SPLIT, len(self.ops) + 1)
+                self._emit_seq(branch)
+                if split is not None:
+                    jumps.append(self._emit(_JMP))
+                    self.ops[split][2] = len(self.ops)
+            for j in jumps:
+                self.ops[j][1] = len(self.ops)
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+            # Greedy and lazy repeats accept the same texts
+            lo, hi, body = av
+            unbounded = hi is sre_parse.MAXREPEAT
+            if lo > _MAX_UNROLL or (not unbounded and hi > _MAX_UNROLL):
+                raise ValueError('repeat count too large')
+            for _ in range(lo):
+                self._emit_seq(body)
+            if unbounded:
+                loop = self._emit(_SPLIT, len(self.ops) + 1)
+                self._emit_seq(body)
+                self._emit(_JMP, loop)
+                self.ops[loop][2] = len(self.ops)
+            else:
+                splits = []
+                for _ in range(hi - lo):
+                    splits.append(self._emit(_SPLIT, len(self.ops) + 1))
+                    self._emit_seq(body)
+                for s in splits:
+                    self.ops[s][2] = len(self.ops)
+        elif op is sre_parse.AT and av in (
+                sre_parse.AT_BEGINNING, sre_parse.AT_BEGINNING_STRING,
+                sre_parse.AT_END, sre_parse.AT_END_STRING,
+                sre_parse.AT_BOUNDARY, sre_parse.AT_NON_BOUNDARY):
+            self._emit(_ASSERT, av)
+        else:
+            raise ValueError(f'unsupported construct {op}')
+
+    @staticmethod
+    def _at(kind, text: str, pos: int) -> bool:
+        n = len(text)
+        if kind in (sre_parse.AT_BEGINNING, sre_parse.AT_BEGINNING_STRING):
+            return pos == 0
+        if kind is sre_parse.AT_END:
+            return pos == n or (pos == n - 1 and text[pos] == '\n')
+        if kind is sre_parse.AT_END_STRING:
+            return pos == n
+        boundary = (pos > 0 and _is_word(text[pos - 1])) != (pos < n and _is_word(text[pos]))
+        return boundary if kind is sre_parse.AT_BOUNDARY else not boundary
+
+    def _static_closure(self, start: int):
+        """Epsilon closure of start as (char states, reaches MATCH), None if it crosses an assertion"""
+        seen = set()
+        states = []
+        matched = False
+        stack = [start]
+        while stack:
+            pc = stack.pop()
+            if pc in seen:
+                continue
+            seen.add(pc)
+            kind, a, b = self.ops[pc]
+            if kind == _CHAR:
+                states.append(pc)
+            elif kind == _SPLIT:
+                stack.append(b)
+                stack.append(a)
+            elif kind == _JMP:
+                stack.append(a)
+            elif kind == _ASSERT:
+                return None
+            else:
+                matched = True
+        return tuple(states), matched
+
+    def _add(self, states: List[int], seen: Set[int], start: int, text: str, pos: int) -> bool:
+        """Add the epsilon closure of start at pos to states; True when MATCH is reached"""
+        closure = self.closures[start]
+        if closure is not None:
+            for pc in closure[0]:
+                if pc not in seen:
+                    seen.add(pc)
+                    states.append(pc)
+            return closure[1]
+        matched = False
+        visited = set()
+        stack = [start]
+        while stack:
+            pc = stack.pop()
+            if pc in visited:
+                continue
+            visited.add(pc)
+            kind, a, b = self.ops[pc]
+            if kind == _CHAR:
+                if pc not in seen:
+                    seen.add(pc)
+                    states.append(pc)
+            elif kind == _SPLIT:
+                stack.append(b)
+                stack.append(a)
+            elif kind == _JMP:
+                stack.append(a)
+            elif kind == _ASSERT:
+                if self._at(a, text, pos):
+                    stack.append(pc + 1)
+            else:
+                matched = True
+        return matched
+
+    def _step(self, states: Tuple[int, ...], c: str) -> Tuple[Tuple[int, ...], bool]:
+        """DFA transition: state set after c, restarted at the next position"""
+        ops = self.ops
+        closures = self.closures
+        nxt = set()
+        for pc in states:
+            if ops[pc][1](c):
+                follow, matched = closures[pc + 1]
+                if matched:
+                    return (), True
+                nxt.update(follow)
+        nxt.update(closures[0][0])
+        result = (tuple(sorted(nxt)), False)
+        if len(self.dfa) >= self.DFA_CACHE_SIZE:
+            self.dfa.clear()
+        self.dfa[(states, c)] = result
+        return result
+
+    def search(self, text: str) -> bool:
+        """True when the pattern matches anywhere in text"""
+        if self.ignorecase:
+            text = fold_text(text)
+        if self.dfa is not None:
+            return self._search_dfa(text)
+        ops = self.ops
+        prefix = self.prefix
+        n = len(text)
+        pos = 0
+        states: List[int] = []
+        seen: Set[int] = set()
+        while True:
+            if not states and prefix:
+                pos = text.find(prefix, pos)
+                if pos < 0:
+                    return False
+                seen = set()
+            if self._add(states, seen, 0, text, pos):
+                return True
+            if pos >= n:
+                return False
+            c = text[pos]
+            pos += 1
+            nxt: List[int] = []
+            seen = set()
+            for pc in states:
+                if ops[pc][1](c) and self._add(nxt, seen, pc + 1, text, pos):
+                    return True
+            states = nxt
+
+    def _search_dfa(self, text: str) -> bool:
+        start, matched = self.closures[0]
+        if matched:
+            return True
+        start = tuple(sorted(start))
+        prefix = self.prefix
+        dfa = self.dfa
+        states = start
+        pos = 0
+        n = len(text)
+        while pos < n:
+            if states == start and prefix:
+                pos = text.find(prefix, pos)
+                if pos < 0:
+                    return False
+            c = text[pos]
+            pos += 1
+            step = dfa.get((states, c))
+            if step is None:
+                step = self._step(states, c)
+            states, matched = step
+            if matched:
+                return True
+        return False
+
+
+# MatchGuard.matcher() default: the rule has not been classified yet
+_UNCLASSIFIED = object()
+
+
+class MatchGuard:
+    """
+    Bounded evaluation of rules flagged as ReDoS-prone.
+
+    Flagged rules run on re2 when it is installed. Without it, CATASTROPHIC
+    rules run on a LinearMatcher and the rest on sre over a capped window of
+    the input. CPython cannot interrupt a running re search, so the time
+    budget is enforced after the fact: a rule that overruns it gets its own
+    window halved for the following requests, and doubled back toward the
+    configured size after RECOVER_AFTER searches within budget, so a stall
+    or a few slow payloads do not weaken the rule for good.
+    """
+
+    # Searches within budget before a shrunk window is doubled again
+    RECOVER_AFTER = 100
+
+    def __init__(self, window: int = 4096, strict_window: int = 1024,
+                 budget_ms: float = 5.0, enabled: bool = True):
+        self.enabled = enabled
+        # Characters of input a flagged rule sees: window for quadratic rules
+        # and linear engines, strict_window for CATASTROPHIC rules left on sre
+        self.window = window
+        self.strict_window = strict_window
+        self.budget_ms = budget_ms
+        self.linear_engine = 're2' if re2 is not None else 'nfa'
+        self.flagged: Dict[str, str] = {}
+        self.strict: Set[str] = set()
+        self.linear: Dict[str, Callable[[str], object]] = {}
+        self.windows: Dict[str, int] = {}
+        self.overruns: Dict[str, int] = {}
+        self.clean: Dict[str, int] = {}
+        self.truncated = 0
+        # Window changes not yet logged by the addon (take_notices)
+        self.notices: List[str] = []
+
+    def matcher(self, pattern: str, compiled: re.Pattern, flags: int,
+                reason=_UNCLASSIFIED) -> Callable[[str], object]:
+        """
+        Return the search callable for a rule, classifying it on the way.
+
+        reason is the rule's redos_risk() when already known (e.g. from the
+        rule cache).
+        """
+        return self._classify(self, pattern, compiled, flags, reason)
+
+    def _classify(self, into, pattern: str, compiled: re.Pattern, flags: int,
+                  reason) -> Callable[[str], object]:
+        """matcher() recording the classification on into (self or a GuardStage)"""
+        if reason is _UNCLASSIFIED:
+            reason = redos_risk(pattern, flags)
+        if reason is None:
+            return compiled.search
+        if pattern not in into.flagged:
+            into.flagged[pattern] = reason
+            catastrophic = is_catastrophic(reason)
+            if re2 is not None:
+                try:
+                    into.linear[pattern] = re2.compile(('(?i)' if flags & re.IGNORECASE else '') + pattern).search
+                except Exception:
+                    # Python-only syntax (backreferences, lookarounds)
+                    pass
+            elif catastrophic:
+                try:
+                    into.linear[pattern] = LinearMatcher(pattern, flags).search
+                except ValueError:
+                    pass
+            if catastrophic and pattern not in into.linear:
+                into.strict.add(pattern)
+        return lambda text: self.search(pattern, compiled, text)
+
+    def stage(self) -> 'GuardStage':
+        """Classification buffer for rules compiled off the request thread"""
+        return GuardStage(self)
+
+    def adopt(self, stage: 'GuardStage'):
+        """
+        Take over the classification of a GuardStage. Call it on the request
+        thread before any rule built on the stage is searched.
+        """
+        for pattern, reason in stage.flagged.items():
+            if pattern in self.flagged:
+                continue
+            self.flagged[pattern] = reason
+            if pattern in stage.linear:
+                self.linear[pattern] = stage.linear[pattern]
+            if pattern in stage.strict:
+                self.strict.add(pattern)
+
+    def _window(self, text: str, window: int) -> str:
+        """Keep the head (request line, first fields) and the tail of text"""
+        if len(text) <= window:
+            return text
+        self.truncated += 1
+        tail = window // 4
+        return text[:window - tail] + '\n' + text[-tail:] if tail else text[:window]
+
+    def search(self, pattern: str, compiled: re.Pattern, text: str):
+        """Search text with a flagged rule under the guard policy"""
+        if not self.enabled:
+            return compiled.search(text)
+        linear = self.linear.get(pattern)
+        if linear is not None:
+            return linear(self._window(text, self.window))
+
+        limit = self.strict_window if pattern in self.strict else self.window
+        window = min(self.windows.get(pattern, limit), limit)
+        text = self._window(text, window)
+        start = time.perf_counter()
+        m = compiled.search(text)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        if elapsed_ms > self.budget_ms:
+            self.overruns[pattern] = self.overruns.get(pattern, 0) + 1
+            self.clean.pop(pattern, None)
+            shrunk = max(window // 2, 256)
+            if shrunk < window:
+                self.windows[pattern] = shrunk
+                self.notices.append(f"rule {pattern[:60]!r} took {elapsed_ms:.1f} ms, "
+                                    f"window {window} -> {shrunk} chars")
+        elif pattern in self.windows:
+            clean = self.clean.get(pattern, 0) + 1
+            if clean < self.RECOVER_AFTER:
+                self.clean[pattern] = clean
+            else:
+                self._recover(pattern, window, limit)
+        return m
+
+    def _recover(self, pattern: str, window: int, limit: int):
+        """Double a shrunk window after RECOVER_AFTER searches within budget"""
+        self.clean.pop(pattern, None)
+        grown = min(window * 2, limit)
+        if grown >= limit:
+            self.windows.pop(pattern, None)
+            self.notices.append(f"rule {pattern[:60]!r} back to its full {limit} char window")
+        else:
+            self.windows[pattern] = grown
+
+    def take_notices(self) -> List[str]:
+        """Return and clear the window changes since the last call"""
+        notices, self.notices = self.notices, []
+        return notices
+
+    def stats(self) -> dict:
+        """Guard counters for the stats file"""
+        return {
+            'enabled': self.enabled,
+            'linear_engine': self.linear_engine,
+            'flagged_rules': len(self.flagged),
+            'linear_rules': len(self.linear),
+            'strict_rules': len(self.strict),
+            'window': self.window,
+            'strict_window': self.strict_window,
+            'budget_ms': self.budget_ms,
+            'truncated_inputs': self.truncated,
+            'budget_overruns': dict(self.overruns),
+            'shrunk_windows': dict(self.windows),
+        }
+
+
+class GuardStage:
+    """
+    Stand-in for a MatchGuard while a ruleset is compiled on another thread.
+
+    matcher() classifies rules into the stage's own tables, so the guard the
+    request path reads is left alone; the returned callables search through
+    the guard once MatchGuard.adopt() has taken the stage over.
+    """
+
+    def __init__(self, guard: MatchGuard):
+        self.guard = guard
+        self.flagged: Dict[str, str] = {}
+        self.strict: Set[str] = set()
+        self.linear: Dict[str, Callable[[str], object]] = {}
+
+    def matcher(self, pattern: str, compiled: re.Pattern, flags: int,
+                reason=_UNCLASSIFIED) -> Callable[[str], object]:
+        return self.guard._classify(self, pattern, compiled, flags, reason)
+
+
+class LiteralPrefilter:
+    """One pass over a folded text reporting which rule literals are present"""
+
+    # Text length above which the character gate pays for itself
+    GATE_LENGTH = 1024
+
+    def __init__(self, pattern_sets: Iterable['PatternSet']):
+        literals = set()
+        for ps in pattern_sets:
+            for required in ps.literals:
+                if required:
+                    literals.update(required)
+        # str.__contains__ runs a C-level two-way search per literal, which on
+        # CPython beats a per-character automaton walk written in Python
+        self.literals: List[str] = sorted(literals)
+        # Characters of each literal: on long texts a literal is only searched
+        # for when all of them occur, which skips most full-length scans
+        self.gates: List[Tuple[str, frozenset]] = [(lit, frozenset(lit)) for lit in self.literals]
+
+    def __len__(self) -> int:
+        return len(self.literals)
+
+    def scan(self, text: str) -> Set[str]:
+        """Return the set of known literals contained in text"""
+        folded = fold_text(text)
+        if len(folded) > self.GATE_LENGTH:
+            chars = set(folded)
+            return {lit for lit, needs in self.gates if needs <= chars and lit in folded}
+        return {lit for lit in self.literals if lit in folded}
+
+
+class PatternSet:
+    """Ordered list of regex patterns compiled once and matched in list order"""
+
+    # evaluate() times one evaluation in this many per pattern
+    TIMING_SAMPLE = 8
+
+    def __init__(self, name: str, patterns: Sequence[str],
+                 labels: Optional[Sequence[str]] = None, flags: int = re.IGNORECASE,
+                 guard: Optional[MatchGuard] = None, analysis: Optional[Sequence[Analysis]] = None,
+                 tiers: Optional[Sequence[object]] = None):
+        self.name = name
+        self.patterns: List[str] = list(patterns)
+        self.labels: List[str] = list(labels) if labels is not None else self.patterns
+        # Patterns are kept as separate objects rather than one big alternation:
+        # sre scans a single pattern with its literal prefix, but tries every
+        # branch at every position of an alternation
+        self.compiled: List[re.Pattern] = [re.compile(p, flags) for p in self.patterns]
+        # analyze_pattern() per pattern, unless a cached analysis is passed in
+        if analysis is None or len(analysis) != len(self.patterns):
+            analysis = [analyze_pattern(p, flags) for p in self.patterns]
+        self.literals: List[Optional[Tuple[str, ...]]] = [literals for literals, _ in analysis]
+        self.risks: List[Optional[str]] = [risk for _, risk in analysis]
+        if guard is not None:
+            self.matchers = [guard.matcher(p, c, flags, risk)
+                             for p, c, risk in zip(self.patterns, self.compiled, self.risks)]
+        else:
+            self.matchers = [c.search for c in self.compiled]
+        # Patterns without a usable literal are always evaluated
+        self.unfiltered: List[int] = [i for i, required in enumerate(self.literals) if not required]
+        self.by_literal: Dict[str, List[int]] = {}
+        for i, required in enumerate(self.literals):
+            for lit in required or ():
+                self.by_literal.setdefault(lit, []).append(i)
+        # Per pattern accounting, updated by evaluate(): every evaluation and
+        # hit is counted, one evaluation in TIMING_SAMPLE is timed
+        self.accounting = True
+        self.evaluations: List[int] = [0] * len(self.patterns)
+        self.hits: List[int] = [0] * len(self.patterns)
+        self.timed: List[int] = [0] * len(self.patterns)
+        self.cost_ns: List[int] = [0] * len(self.patterns)
+        # Tiers: runs of adjacent patterns with equal tier keys, whose matches
+        # give the caller the same result (default: one pattern per tier).
+        # reorder() may permute patterns inside a tier, never across tiers
+        keys = list(tiers) if tiers is not None and len(tiers) == len(self.patterns) else list(range(len(self.patterns)))
+        self.tier_spans: List[Tuple[int, int]] = []
+        for i, key in enumerate(keys):
+            if i and key == keys[i - 1]:
+                self.tier_spans[-1] = (self.tier_spans[-1][0], i + 1)
+            else:
+                self.tier_spans.append((i, i + 1))
+        # Evaluation position of each pattern; list order until reorder()
+        self.rank: List[int] = list(range(len(self.patterns)))
+        self.reordered = False
+
+    def __len__(self) -> int:
+        return len(self.patterns)
+
+    @property
+    def analysis(self) -> List[Analysis]:
+        """Per pattern (literals, ReDoS risk), as accepted back by __init__"""
+        return list(zip(self.literals, self.risks))
+
+    @property
+    def filtered(self) -> int:
+        """Number of patterns guarded by a literal prefilter"""
+        return len(self.patterns) - len(self.unfiltered)
+
+    def candidates(self, text: str, present: Optional[Set[str]] = None) -> List[int]:
+        """Indices (in list order) of the patterns whose literals are present"""
+        if present is None:
+            folded = fold_text(text)
+            present = [lit for lit in self.by_literal if lit in folded]
+        selected = set(self.unfiltered)
+        for lit in present:
+            indices = self.by_literal.get(lit)
+            if indices:
+                selected.update(indices)
+        if self.reordered:
+            return sorted(selected, key=self.rank.__getitem__)
+        return sorted(selected)
+
+    def evaluate(self, i: int, text: str):
+        """Match pattern i against text, counting the evaluation, a hit and sampled time"""
+        if not self.accounting:
+            return self.matchers[i](text)
+        self.evaluations[i] += 1
+        if self.evaluations[i] % self.TIMING_SAMPLE == 1:
+            start = time.perf_counter_ns()
+            m = self.matchers[i](text)
+            self.cost_ns[i] += time.perf_counter_ns() - start
+            self.timed[i] += 1
+        else:
+            m = self.matchers[i](text)
+        if m:
+            self.hits[i] += 1
+        return m
+
+    def mean_ns(self, i: int) -> float:
+        """Mean time of one evaluation of pattern i, from the timed sample"""
+        return self.cost_ns[i] / self.timed[i] if self.timed[i] else 0.0
+
+    def _expected_cost(self, i: int) -> float:
+        """Mean match time over the (smoothed) hit rate - lower goes first"""
+        return (self.mean_ns(i) + 1) * (self.evaluations[i] + 2) / (self.hits[i] + 1)
+
+    def reorder(self) -> bool:
+        """
+        Evaluate the patterns of each tier by increasing expected cost per hit.
+
+        Tiers keep their list order, so the tier of the first match - and so
+        the caller's result - is the same as in list order. Returns True
+        when the evaluation order changed.
+        """
+        changed = False
+        for start, end in self.tier_spans:
+            if end - start < 2:
+                continue
+            ordered = sorted(range(start, end), key=lambda i: (self._expected_cost(i), i))
+            for position, i in enumerate(ordered, start):
+                if self.rank[i] != position:
+                    self.rank[i] = position
+                    changed = True
+        self.reordered = any(r != i for i, r in enumerate(self.rank))
+        return changed
+
+    def reset_order(self):
+        """Back to list order"""
+        self.rank = list(range(len(self.patterns)))
+        self.reordered = False
+
+    def rule_stats(self) -> List[dict]:
+        """Per pattern counters, in list order"""
+        return [{
+            'pattern': pattern,
+            'label': label,
+            'evaluations': self.evaluations[i],
+            'hits': self.hits[i],
+            # Estimated from the timed sample
+            'time_ms': round(self.mean_ns(i) * self.evaluations[i] / 1e6, 3),
+            'mean_us': round(self.mean_ns(i) / 1000, 2),
+            'position': self.rank[i],
+        } for i, (pattern, label) in enumerate(zip(self.patterns, self.labels))]
+
+    def search(self, text: str, present: Optional[Set[str]] = None) -> Optional[int]:
+        """
+        Return the index of the first pattern (in list order) found in text.
+
+        present is the set of literals found by a LiteralPrefilter scan over
+        text (or over a superset of it). When omitted, literals are checked
+        directly against text.
+        """
+        for i in self.candidates(text, present):
+            if self.evaluate(i, text):
+                return i
+        return None
+
+    def first_match(self, text: str, present: Optional[Set[str]] = None) -> Optional[str]:
+        """Return the first matching pattern string, or None"""
+        i = self.search(text, present)
+        return self.patterns[i] if i is not None else None
+
+    def first_label(self, text: str, present: Optional[Set[str]] = None) -> Optional[str]:
+        """Return the label of the first matching pattern, or None"""
+        i = self.search(text, present)
+        return self.labels[i] if i is not None else None
+
+
+def compile_pattern_sets(categories: Dict[str, Sequence[str]],
+                         guard: Optional[MatchGuard] = None,
+                         analysis: Optional[Dict[str, Sequence[Analysis]]] = None,
+                         single_tier: Iterable[str] = ()) -> Dict[str, PatternSet]:
+    """
+    Compile a {category: [patterns]} mapping into PatternSets.
+
+    Categories named in single_tier are compiled as one tier: the caller
+    only cares whether one of their patterns matched, not which.
+    """
+    analysis = analysis or {}
+    single_tier = set(single_tier)
+    return {name: PatternSet(name, patterns, guard=guard, analysis=analysis.get(name),
+                             tiers=[name] * len(patterns) if name in single_tier else None)
+            for name, patterns in categories.items()}
+
+
+def compile_labeled_set(name: str, groups: Dict[str, Sequence[str]],
+                        guard: Optional[MatchGuard] = None,
+                        analysis: Optional[Sequence[Analysis]] = None) -> PatternSet:
+    """
+    Compile a {label: [patterns]} mapping (e.g. CVE_PATTERNS) into one PatternSet.
+
+    The patterns of a label form one tier, for callers using first_label().
+    """
+    patterns = []
+    labels = []
+    for label, group in groups.items():
+        for pattern in group:
+            patterns.append(pattern)
+            labels.append(label)
+    return PatternSet(name, patterns, labels=labels, guard=guard, analysis=analysis, tiers=labels)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+SecuBox WAF Body Inspection
+Chooses how much of a request body the detectors see, by Content-Type
+Text bodies are scanned through a head/tail window, form and JSON bodies
+up to a cap, multipart bodies part by part, and binary or media bodies
+only through a short sample - so multi-megabyte uploads are never fully
+decoded and regex-scanned
+"""
+
+import re
+from typing import List, NamedTuple
+
+# Default text window: bytes kept from the start and the end of a body
+# larger than both together (0 head = whole body)
+BODY_HEAD = 65536
+BODY_TAIL = 16384
+
+# Content types inspected through a sample only (prefix match on the
+# lowercased media type)
+BINARY_TYPES = (
+    'image/', 'audio/', 'video/', 'font/',
+    'application/octet-stream', 'application/zip', 'application/gzip',
+    'application/x-gzip', 'application/x-tar', 'application/x-7z-compressed',
+    'application/x-rar', 'application/pdf', 'application/wasm',
+    'application/x-protobuf', 'application/protobuf', 'application/grpc',
+    'application/msgpack', 'application/x-msgpack', 'application/vnd.',
+    'application/pkcs7-mime', 'application/pkcs7-signature',
+    'application/x-pkcs7-mime',
+)
+
+# Multipart part types that are scanned as text
+_TEXT_PART_TYPES = ('text/', 'application/json', 'application/xml', 'application/x-www-form-urlencoded')
+
+_BOUNDARY_RE = re.compile(r'boundary="?([^";,]+)"?', re.IGNORECASE)
+
+
+class InspectedBody(NamedTuple):
+    """Scan text of a body and how it was obtained"""
+    text: str
+    strategy: str
+    inspected: int
+    skipped: int
+
+
+def body_strategy(content_type: str) -> str:
+    """Inspection strategy name for a lowercased Content-Type"""
+    if content_type.startswith('multipart/'):
+        return 'multipart'
+    if 'application/x-www-form-urlencoded' in content_type:
+        return 'form'
+    if 'json' in content_type:
+        return 'json'
+    if content_type.startswith(BINARY_TYPES):
+        return 'binary'
+    return 'text'
+
+
+def _decode(data: bytes) -> str:
+    return data.decode('utf-8', errors='ignore').lower() if data else ''
+
+
+class BodyInspector:
+    """Per-strategy byte caps; inspect() turns a raw body into scan text"""
+
+    def __init__(self, text_head: int = BODY_HEAD, text_tail: int = BODY_TAIL,
+                 form_cap: int = 65536, json_cap: int = 65536,
+                 part_cap: int = 16384, max_parts: int = 32,
+                 binary_sample: int = 512):
+        self.text_head = text_head
+        self.text_tail = text_tail
+        # Form and JSON bodies are scanned up to their cap (0 = no cap)
+        self.form_cap = form_cap
+        self.json_cap = json_cap
+        # Per multipart part: text parts up to part_cap (0 = no cap), at most max_parts parts
+        self.part_cap = part_cap
+        self.max_parts = max_parts
+        # Leading bytes of binary bodies and binary parts (0 = skip them)
+        self.binary_sample = binary_sample
+
+    def inspect(self, content: bytes, content_type: str) -> InspectedBody:
+        """Scan text for a body given its Content-Type header"""
+        if not content:
+            return InspectedBody('', 'empty', 0, 0)
+        # The multipart boundary is case-sensitive: only the media type is lowered
+        strategy = body_strategy(content_type.lower())
+        if strategy == 'multipart':
+            boundary = _BOUNDARY_RE.search(content_type)
+            if boundary:
+                return self._multipart(content, boundary.group(1).encode('latin-1', errors='ignore'))
+            strategy = 'text'
+        if strategy == 'form':
+            return self._head(content, self.form_cap, strategy)
+        if strategy == 'json':
+            return self._head(content, self.json_cap, strategy)
+        if strategy == 'binary':
+            sample = content[:max(self.binary_sample, 0)]
+            return InspectedBody(_decode(sample), strategy, len(sample), len(content) - len(sample))
+        return self._window(content)
+
+    @staticmethod
+    def _head(content: bytes, cap: int, strategy: str) -> InspectedBody:
+        scanned = content[:cap] if cap > 0 else content
+        return InspectedBody(_decode(scanned), strategy, len(scanned), len(content) - len(scanned))
+
+    def _window(self, content: bytes) -> InspectedBody:
+        head, tail = self.text_head, self.text_tail
+        if not head or len(content) <= head + tail:
+            return InspectedBody(_decode(content), 'text', len(content), 0)
+        tail_bytes = content[-tail:] if tail else b''
+        text = _decode(content[:head]) + '\n' + _decode(tail_bytes)
+        inspected = head + len(tail_bytes)
+        return InspectedBody(text, 'text', inspected, len(content) - inspected)
+
+    def _multipart(self, content: bytes, boundary: bytes) -> InspectedBody:
+        """Part headers always, text parts up to part_cap, binary parts sampled"""
+        delimiter = b'--' + boundary
+        chunks: List[str] = []
+        inspected = 0
+        pos = content.find(delimiter)
+        parts = 0
+        while pos >= 0 and parts < self.max_parts:
+            start = pos + len(delimiter)
+            if content[start:start + 2] == b'--':
+                break
+            end = content.find(delimiter, start)
+            part_end = end if end >= 0 else len(content)
+            sep = content.find(b'\r\n\r\n', start, part_end)
+            if sep < 0:
+                sep = content.find(b'\n\n', start, part_end)
+                body_start = sep + 2 if sep >= 0 else part_end
+            else:
+                body_start = sep + 4
+            header_end = sep if sep >= 0 else part_end
+            headers = _decode(content[start:header_end])
+            part_type = ''
+            for line in headers.splitlines():
+                if line.startswith('content-type:'):
+                    part_type = line[13:].strip()
+            # Unnamed file uploads and form fields default to text
+            binary = part_type.startswith(BINARY_TYPES) or (
+                bool(part_type) and not part_type.startswith(_TEXT_PART_TYPES))
+            if binary:
+                body_end = min(part_end, body_start + max(self.binary_sample, 0))
+            elif self.part_cap > 0:
+                body_end = min(part_end, body_start + self.part_cap)
+            else:
+                body_end = part_end
+            body = content[body_start:body_end]
+            chunks.append(headers)
+            chunks.append(_decode(body))
+            inspected += (header_end - start) + len(body)
+            parts += 1
+            pos = end
+        if not chunks:
+            return self._window(content)
+        return InspectedBody('\n'.join(chunks), 'multipart', inspected, max(len(content) - inspected, 0))
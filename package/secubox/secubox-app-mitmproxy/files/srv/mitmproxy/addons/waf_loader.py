@@ -3,143 +3,581 @@
 SecuBox WAF Rules Loader
 Dynamically loads threat detection patterns from JSON config
 Supports modular enable/disable per category
+Rules are compiled into an immutable WafRuleset snapshot; a reload builds a
+new snapshot and swaps it in with one assignment, so a request in flight
+always sees a complete ruleset. poll() watches the rules and config files
+by mtime and recompiles them on a background thread
+With a RuleCache, the validated rules and their pattern analysis are kept
+under /data keyed by the content of both files, so a restart with unchanged
+files skips validation and analysis
 """
 
+import copy
 import json
 import re
 import os
-from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+import threading
+import time
+from typing import Dict, FrozenSet, List, NamedTuple, Optional, Tuple
+
+from waf_cache import RuleCache, dump_analysis, load_analysis
+from waf_engine import LiteralPrefilter, MatchGuard, PatternSet
 
 WAF_RULES_FILE = "/data/waf-rules.json"
 WAF_CONFIG_FILE = "/data/waf-config.json"
+# RuleCache entry holding the normalized waf-rules.json
+CACHE_NAME = "waf-rules"
+
+
+# Request parts a rule can be matched against ("header:<name>" is matched
+# against the "<name>: <value>" line of that header)
+TARGETS = ("url", "path", "query", "body", "ua")
+# Targets of rules that declare none (url is the path with its query string)
+DEFAULT_TARGETS = ("url", "body", "ua")
+# Legacy "check" values and the targets they stand for
+CHECK_TARGETS = {"user-agent": ("ua",), "body": ("body",), "url": ("url",)}
+
+
+def parse_targets(value) -> Tuple[str, ...]:
+    """Validate a "targets" list; raises ValueError on an unknown target"""
+    if isinstance(value, str):
+        value = [value]
+    targets = []
+    for target in value or ():
+        target = str(target).strip().lower()
+        if target.startswith("header:") and len(target) > 7:
+            target = "header:" + target[7:].strip()
+        elif target not in TARGETS:
+            raise ValueError(f"unknown target '{target}'")
+        if target not in targets:
+            targets.append(target)
+    if not targets:
+        raise ValueError("empty target list")
+    return tuple(targets)
+
+
+class RuleCategory(NamedTuple):
+    """One enabled category of waf-rules.json, compiled"""
+    id: str
+    name: str
+    severity: str
+    patterns: PatternSet
+    # Per rule, in pattern order: (rule_id, desc, cve)
+    rules: List[Tuple[str, str, str]]
+    # Target -> indices of the rules that apply to it
+    targets: Dict[str, FrozenSet[int]]
+
+
+class WafRuleset:
+    """Compiled snapshot of the enabled categories - never modified once built"""
+
+    def __init__(self, categories: List[RuleCategory], version: int = 0, loaded_at: float = 0.0):
+        self.categories = categories
+        self.version = version
+        self.loaded_at = loaded_at
+        self.total_rules = sum(len(c.rules) for c in categories)
+        self.prefilter = LiteralPrefilter([c.patterns for c in categories])
+        # Targets some rule applies to, in evaluation order; only these are
+        # extracted from a request
+        used = set()
+        for cat in categories:
+            used.update(cat.targets)
+        self.used_targets = [t for t in TARGETS if t in used] + sorted(t for t in used if t not in TARGETS)
+        self.header_names = [t[7:] for t in self.used_targets if t.startswith("header:")]
+        # Categories worth visiting: those with an always-evaluated rule, and
+        # per prefilter literal those with a rule needing it
+        self.unfiltered = {ci for ci, cat in enumerate(categories) if cat.patterns.unfiltered}
+        self.by_literal: Dict[str, set] = {}
+        for ci, cat in enumerate(categories):
+            for lit in cat.patterns.by_literal:
+                self.by_literal.setdefault(lit, set()).add(ci)
+
+    def __len__(self) -> int:
+        return self.total_rules
+
+    def target_counts(self) -> Dict[str, int]:
+        """Number of rules applying to each target"""
+        counts: Dict[str, int] = {}
+        for cat in self.categories:
+            for target, members in cat.targets.items():
+                counts[target] = counts.get(target, 0) + len(members)
+        return {t: counts[t] for t in self.used_targets}
+
+    def targets(self, url: str, body: str, headers) -> Dict[str, str]:
+        """
+        Texts of the targets the rules use, from a request.
+
+        url is the path with its query string; headers is any mapping with
+        case-insensitive get() (mitmproxy Headers) or lowercased keys.
+        """
+        texts: Dict[str, str] = {}
+        for target in self.used_targets:
+            if target == "url":
+                texts[target] = url
+            elif target == "path":
+                texts[target] = url.split("?", 1)[0]
+            elif target == "query":
+                texts[target] = url.split("?", 1)[1] if "?" in url else ""
+            elif target == "body":
+                texts[target] = body
+            elif target == "ua":
+                texts[target] = headers.get("user-agent", "")
+            else:
+                name = target[7:]
+                value = headers.get(name, "")
+                texts[target] = f"{name}: {value}" if value else ""
+        return texts
+
+    def check(self, url: str, body: str, headers) -> Optional[dict]:
+        """match() over the targets of a request"""
+        if not self.categories:
+            return None
+        return self.match(self.targets(url, body, headers))
+
+    def rule_stats(self) -> Dict[str, List[dict]]:
+        """Per rule counters of each category (labelled with the rule ids)"""
+        stats = {}
+        for cat in self.categories:
+            entries = cat.patterns.rule_stats()
+            for entry, (rule_id, _desc, _cve) in zip(entries, cat.rules):
+                entry["label"] = rule_id
+            stats[cat.id] = entries
+        return stats
+
+    def match(self, targets: Dict[str, str]) -> Optional[dict]:
+        """
+        First rule (category order, then rule order) matching one of its targets.
+
+        Each target text is only searched by the rules that apply to it.
+        """
+        if not self.categories:
+            return None
+        # Literals found in the targets. Long texts are scanned one at a time
+        # so a short header cannot open the character gate of a large body;
+        # short ones are joined into a single scan. Targets contained in
+        # another one (path in url, ua in its header line) are covered by it
+        parts: List[str] = []
+        for text in sorted((v for v in targets.values() if v), key=len, reverse=True):
+            if not any(text in part for part in parts):
+                parts.append(text)
+        present = set()
+        short: List[str] = []
+        for text in parts:
+            if len(text) > self.prefilter.GATE_LENGTH:
+                present |= self.prefilter.scan(text)
+            else:
+                short.append(text)
+        if short:
+            present |= self.prefilter.scan('\n'.join(short))
+        visit = set(self.unfiltered)
+        for lit in present:
+            visit.update(self.by_literal.get(lit, ()))
+        for ci in sorted(visit):
+            cat = self.categories[ci]
+            candidates = cat.patterns.candidates('', present)
+            if not candidates:
+                continue
+            evaluate = cat.patterns.evaluate
+            best = None
+            best_target = None
+            for target_name, target_value in targets.items():
+                members = cat.targets.get(target_name)
+                if not target_value or not members:
+                    continue
+                for i in candidates:
+                    # An earlier rule already matched another target
+                    if best is not None and i >= best:
+                        break
+                    if i in members and evaluate(i, target_value):
+                        best = i
+                        best_target = target_name
+                        break
+            if best is not None:
+                rule_id, desc, cve = cat.rules[best]
+                return {
+                    "matched": True,
+                    "category": cat.id,
+                    "rule_id": rule_id,
+                    "description": desc,
+                    "severity": cat.severity,
+                    "cve": cve,
+                    "pattern": cat.patterns.patterns[best],
+                    "target": best_target
+                }
+        return None
+
+
+def _file_signature(path: str) -> Optional[Tuple[int, int, int]]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
 
 class WafRulesLoader:
-    def __init__(self):
+    def __init__(self, rules_file: Optional[str] = None, config_file: Optional[str] = None,
+                 guard: Optional[MatchGuard] = None, reload_interval: float = 2.0,
+                 cache: Optional[RuleCache] = None):
+        self.rules_file = rules_file or WAF_RULES_FILE
+        self.config_file = config_file or WAF_CONFIG_FILE
+        # ReDoS guard shared with the built-in detection patterns (optional)
+        self.guard = guard
+        # Seconds between mtime checks in poll() (0 = no hot reload)
+        self.reload_interval = reload_interval
+        # Normalized rulesets keyed by the content of both files (optional)
+        self.cache = cache
+        # Last parsed rules file (left as is when the ruleset came from the cache)
         self.rules: Dict = {}
-        self.compiled_patterns: Dict[str, List[Tuple[str, re.Pattern, str, str]]] = {}
         self.enabled_categories: set = set()
+        self.ruleset = WafRuleset([])
+        self.reloads = 0
+        self.errors: List[str] = []
+        self.load_ms = 0.0
+        self.from_cache = False
+        self._signature = None
+        self._next_check = 0.0
+        # (loader copy, ruleset or None) left by the reload thread for poll()
+        self._staged: Optional[Tuple["WafRulesLoader", Optional[WafRuleset]]] = None
+        self._building = False
+        self._error: Optional[str] = None
         self.load_rules()
-    
+
     def load_rules(self):
         """Load rules from JSON file"""
-        try:
-            if os.path.exists(WAF_RULES_FILE):
-                with open(WAF_RULES_FILE, "r") as f:
-                    self.rules = json.load(f)
-        except Exception as e:
-            print(f"[WAF] Error loading rules: {e}")
+        self._signature = self.sources_signature()
+        ruleset = self._load(self.ruleset.version + 1)
+        if ruleset is not None:
+            self.ruleset = ruleset
+            return
+        # Missing or unreadable rules file: the last good rules stay, under
+        # the current config
+        if not self.rules:
             self.rules = {"categories": {}}
-        
-        # Load enabled categories from config
         self.load_config()
-        
-        # Compile patterns
         self.compile_patterns()
-    
-    def load_config(self):
+
+    def _load(self, version: int) -> Optional[WafRuleset]:
+        """
+        Ruleset for the current rule and config files, from the cache when
+        their content is unchanged; None when the rules file cannot be read.
+        """
+        start = time.perf_counter()
+        rules_data = self._read_source(self.rules_file)
+        if rules_data is None:
+            return None
+        config_data = self._read_source(self.config_file)
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(rules_data, config_data or b"")
+            ruleset = self._from_cache(self.cache.load(CACHE_NAME, key), version)
+            if ruleset is not None:
+                self.load_ms = (time.perf_counter() - start) * 1000
+                self.from_cache = True
+                return ruleset
+        rules = self._read_rules(rules_data)
+        if rules is None:
+            return None
+        self.rules = rules
+        self.load_config(config_data)
+        problems: List[str] = []
+        normalized = self._normalize(rules, self.enabled_categories, problems)
+        for problem in problems:
+            self._report(problem)
+        ruleset = self._build(normalized, version)
+        if key is not None:
+            self.cache.store(CACHE_NAME, key, {
+                "enabled": sorted(self.enabled_categories),
+                "categories": normalized,
+                "analysis": dump_analysis({c.id: c.patterns for c in ruleset.categories}),
+                "problems": problems,
+            })
+        self.load_ms = (time.perf_counter() - start) * 1000
+        self.from_cache = False
+        return ruleset
+
+    def _from_cache(self, payload: Optional[Dict], version: int) -> Optional[WafRuleset]:
+        """Rebuild a ruleset from a cached payload; None when it is unusable"""
+        if not payload:
+            return None
+        try:
+            normalized = payload["categories"]
+            ruleset = self._build(normalized, version, payload.get("analysis"))
+            self.enabled_categories = set(payload.get("enabled", ()))
+        except (KeyError, TypeError, ValueError, re.error):
+            return None
+        # Problems found when the entry was written still apply to these files
+        for problem in payload.get("problems", ()):
+            self._report(problem)
+        return ruleset
+
+    def _read_source(self, path: str) -> Optional[bytes]:
+        """Raw content of a rule source; None when missing or unreadable"""
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            self._report(f"Error reading {path}: {e}")
+            return None
+
+    def _read_rules(self, data: Optional[bytes] = None) -> Optional[Dict]:
+        """Parsed rules file; None when missing or unreadable (the last good rules stay)"""
+        try:
+            if data is None:
+                data = self._read_source(self.rules_file)
+            if data is not None:
+                rules = json.loads(data)
+                if not isinstance(rules.get("categories", {}), dict):
+                    raise ValueError("'categories' is not an object")
+                return rules
+        except Exception as e:
+            self._report(f"Error loading rules: {e}")
+        return None
+
+    def load_config(self, data: Optional[bytes] = None):
         """Load enabled categories from config file"""
-        self.enabled_categories = set()
+        all_categories = set(self.rules.get("categories", {}).keys())
+        self.enabled_categories = set(all_categories)
         try:
-            if os.path.exists(WAF_CONFIG_FILE):
-                with open(WAF_CONFIG_FILE, "r") as f:
-                    config = json.load(f)
-                    for cat, enabled in config.get("categories", {}).items():
-                        if enabled:
-                            self.enabled_categories.add(cat)
-            else:
-                # Default: enable all categories
-                for cat in self.rules.get("categories", {}).keys():
-                    self.enabled_categories.add(cat)
+            if data is None:
+                data = self._read_source(self.config_file)
+            if data is not None:
+                config = json.loads(data)
+                if not config.get("enabled", True):
+                    self.enabled_categories = set()
+                    return
+                # Categories the config does not list stay enabled, so rules
+                # added to waf-rules.json do not need a config update first
+                for cat, enabled in config.get("categories", {}).items():
+                    if not enabled:
+                        self.enabled_categories.discard(cat)
         except Exception as e:
-            print(f"[WAF] Error loading config: {e}")
+            self._report(f"Error loading config: {e}")
             # Enable all on error
-            for cat in self.rules.get("categories", {}).keys():
-                self.enabled_categories.add(cat)
-    
+            self.enabled_categories = all_categories
+
     def compile_patterns(self):
-        """Compile regex patterns for enabled categories"""
-        self.compiled_patterns = {}
-        
-        for cat_id, cat_data in self.rules.get("categories", {}).items():
-            if cat_id not in self.enabled_categories:
+        """Compile regex patterns for enabled categories and swap the ruleset in"""
+        self.ruleset = self._compile(self.rules, self.enabled_categories, self.ruleset.version + 1)
+
+    def _compile(self, rules: Dict, enabled: set, version: int) -> WafRuleset:
+        problems: List[str] = []
+        normalized = self._normalize(rules, enabled, problems)
+        for problem in problems:
+            self._report(problem)
+        return self._build(normalized, version)
+
+    @staticmethod
+    def _normalize(rules: Dict, enabled: set, problems: List[str]) -> List[Dict]:
+        """
+        Validated, JSON-ready form of the enabled rules.
+
+        Disabled categories and rules and invalid patterns are dropped, and
+        every rule carries its resolved targets. Problems are appended to
+        problems.
+        """
+        categories = []
+        for cat_id, cat_data in rules.get("categories", {}).items():
+            if cat_id not in enabled:
                 continue
-            
+
             if not cat_data.get("enabled", True):
                 continue
-            
-            self.compiled_patterns[cat_id] = []
-            severity = cat_data.get("severity", "medium")
-            
+
+            default_targets = DEFAULT_TARGETS
+            if "targets" in cat_data:
+                try:
+                    default_targets = parse_targets(cat_data["targets"])
+                except ValueError as e:
+                    problems.append(f"Category {cat_id}: {e} - using {', '.join(DEFAULT_TARGETS)}")
+            cat_rules = []
             for rule in cat_data.get("patterns", []):
+                if not rule.get("enabled", True):
+                    continue
+                rule_id = rule.get("id", "unknown")
                 try:
-                    pattern = re.compile(rule["pattern"], re.IGNORECASE)
-                    rule_id = rule.get("id", "unknown")
-                    desc = rule.get("desc", "")
-                    cve = rule.get("cve", "")
-                    self.compiled_patterns[cat_id].append((rule_id, pattern, desc, severity, cve))
-                except re.error as e:
-                    print(f"[WAF] Invalid pattern {rule.get(id)}: {e}")
-    
+                    re.compile(rule["pattern"], re.IGNORECASE)
+                except (re.error, KeyError, TypeError) as e:
+                    problems.append(f"Invalid pattern {rule_id}: {e}")
+                    continue
+                rule_targets = default_targets
+                try:
+                    if "targets" in rule:
+                        rule_targets = parse_targets(rule["targets"])
+                    elif rule.get("check") in CHECK_TARGETS:
+                        rule_targets = CHECK_TARGETS[rule["check"]]
+                except ValueError as e:
+                    problems.append(f"Rule {rule_id}: {e} - using the category targets")
+                cat_rules.append({
+                    "id": rule_id,
+                    "desc": rule.get("desc", ""),
+                    "cve": rule.get("cve", ""),
+                    "pattern": rule["pattern"],
+                    "targets": list(rule_targets),
+                })
+            if cat_rules:
+                categories.append({
+                    "id": cat_id,
+                    "name": cat_data.get("name", cat_id),
+                    "severity": cat_data.get("severity", "medium"),
+                    "rules": cat_rules,
+                })
+        return categories
+
+    def _build(self, normalized: List[Dict], version: int,
+               analysis: Optional[Dict] = None) -> WafRuleset:
+        """Compile normalized categories, reusing a dump_analysis() payload when given"""
+        categories = []
+        for cat in normalized:
+            patterns = []
+            meta = []
+            targets: Dict[str, List[int]] = {}
+            for rule in cat["rules"]:
+                for target in rule["targets"]:
+                    targets.setdefault(target, []).append(len(patterns))
+                patterns.append(rule["pattern"])
+                meta.append((rule["id"], rule["desc"], rule["cve"]))
+            categories.append(RuleCategory(
+                cat["id"], cat["name"], cat["severity"],
+                PatternSet(cat["id"], patterns, guard=self.guard,
+                           analysis=load_analysis(analysis, cat["id"])), meta,
+                {t: frozenset(indices) for t, indices in targets.items()}))
+        return WafRuleset(categories, version, time.time())
+
+    def sources_signature(self) -> tuple:
+        """mtime/size/inode of the rules and config files"""
+        return (_file_signature(self.rules_file), _file_signature(self.config_file))
+
+    def changed(self) -> bool:
+        return self.sources_signature() != self._signature
+
+    def poll(self, now: Optional[float] = None) -> Optional[WafRuleset]:
+        """
+        Hot reload step, cheap enough for every request.
+
+        Every reload_interval seconds the source files are stat()ed; when
+        they changed, a background thread recompiles them. The call after
+        the build finishes swaps the new ruleset in and returns it.
+        """
+        staged = self._staged
+        if staged is not None:
+            self._staged = None
+            return self._publish(*staged)
+        if self.reload_interval <= 0 or self._building:
+            return None
+        now = time.time() if now is None else now
+        if now < self._next_check:
+            return None
+        self._next_check = now + self.reload_interval
+        if self.changed():
+            self._building = True
+            threading.Thread(target=self._rebuild, name='secubox-waf-reload', daemon=True).start()
+        return None
+
+    def _rebuild(self):
+        """
+        Recompile the rule files on a copy of the loader (reload thread).
+
+        The copy takes the parsed rules, load timings and errors, and flagged
+        rules are classified on a GuardStage, so nothing the request thread
+        reads changes here. The result is handed over in one assignment.
+        """
+        builder = copy.copy(self)
+        builder._error = None
+        if self.guard is not None:
+            builder.guard = self.guard.stage()
+        ruleset = None
+        try:
+            signature = builder.sources_signature()
+            # None keeps serving the current ruleset until the file parses again
+            ruleset = builder._load(self.ruleset.version + 1)
+            builder._signature = signature
+        except Exception as e:
+            builder._report(f"Reload failed: {e}")
+        finally:
+            self._staged = (builder, ruleset)
+            self._building = False
+
+    def _publish(self, builder: "WafRulesLoader", ruleset: Optional[WafRuleset]) -> Optional[WafRuleset]:
+        """Apply a reload thread build (request thread)"""
+        if self.guard is not None:
+            self.guard.adopt(builder.guard)
+        self.rules = builder.rules
+        self.enabled_categories = builder.enabled_categories
+        self.load_ms = builder.load_ms
+        self.from_cache = builder.from_cache
+        self.errors = builder.errors
+        self._signature = builder._signature
+        if builder._error is not None:
+            self._error = builder._error
+        if ruleset is None:
+            return None
+        self.ruleset = ruleset
+        self.reloads += 1
+        return ruleset
+
+    def _report(self, message: str):
+        print(f"[WAF] {message}")
+        self._error = message
+        self.errors = (self.errors + [message])[-10:]
+
+    def take_error(self) -> Optional[str]:
+        """Return and clear the last load error"""
+        error, self._error = self._error, None
+        return error
+
     def check_request(self, path: str, query: str, body: str, headers: dict) -> Optional[dict]:
         """Check request against all enabled rules"""
-        # Combine path, query and body for checking
+        # Combine path and query for the url target
         full_url = f"{path}?{query}" if query else path
-        check_targets = {
-            "url": full_url,
-            "body": body,
-            "user-agent": headers.get("user-agent", "")
-        }
-        
-        for cat_id, patterns in self.compiled_patterns.items():
-            for rule_id, pattern, desc, severity, cve in patterns:
-                # Check appropriate target based on rule
-                for target_name, target_value in check_targets.items():
-                    if target_value and pattern.search(target_value):
-                        return {
-                            "matched": True,
-                            "category": cat_id,
-                            "rule_id": rule_id,
-                            "description": desc,
-                            "severity": severity,
-                            "cve": cve,
-                            "pattern": pattern.pattern,
-                            "target": target_name
-                        }
-        
-        return None
-    
+        return self.ruleset.check(full_url, body, {k.lower(): v for k, v in headers.items()})
+
     def get_stats(self) -> dict:
         """Get rule statistics"""
-        total_rules = 0
+        ruleset = self.ruleset
         categories = []
-        for cat_id, patterns in self.compiled_patterns.items():
-            total_rules += len(patterns)
-            cat_data = self.rules.get("categories", {}).get(cat_id, {})
+        for cat in ruleset.categories:
             categories.append({
-                "id": cat_id,
-                "name": cat_data.get("name", cat_id),
-                "rules": len(patterns),
-                "severity": cat_data.get("severity", "medium")
+                "id": cat.id,
+                "name": cat.name,
+                "rules": len(cat.rules),
+                "severity": cat.severity,
+                "targets": {t: len(members) for t, members in cat.targets.items()}
             })
-        
+
         return {
-            "total_rules": total_rules,
-            "enabled_categories": len(self.compiled_patterns),
-            "categories": categories
+            "total_rules": ruleset.total_rules,
+            "enabled_categories": len(ruleset.categories),
+            "categories": categories,
+            "targets": ruleset.target_counts(),
+            "version": ruleset.version,
+            "loaded_at": int(ruleset.loaded_at),
+            "reloads": self.reloads,
+            "load_ms": round(self.load_ms, 1),
+            "from_cache": self.from_cache,
+            "errors": list(self.errors)
         }
 
-# Global instance
-waf_loader = WafRulesLoader()
+# Global instance, built on first use: the analytics addon imports this
+# module for WafRulesLoader and loads its own rules
+waf_loader: Optional[WafRulesLoader] = None
+
+def _global_loader() -> WafRulesLoader:
+    global waf_loader
+    if waf_loader is None:
+        waf_loader = WafRulesLoader(cache=RuleCache())
+    return waf_loader
 
 def check_threat(path: str, query: str = "", body: str = "", headers: dict = None) -> Optional[dict]:
     """Convenience function for threat checking"""
-    return waf_loader.check_request(path, query, body, headers or {})
+    return _global_loader().check_request(path, query, body, headers or {})
 
 def reload_rules():
     """Reload rules from disk"""
-    waf_loader.load_rules()
+    _global_loader().load_rules()
 
 def get_waf_stats() -> dict:
     """Get WAF statistics"""
-    return waf_loader.get_stats()
+    return _global_loader().get_stats()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+SecuBox Buffered Log Writer
+Background writer for the access and threat logs of the analytics addon
+Request handlers only enqueue a line; a thread appends batches to files it
+keeps open, rotates them by size and flushes what is left on shutdown
+Lines are written whole and in order, so CrowdSec can keep tailing the files
+"""
+
+import os
+import threading
+from collections import deque
+from typing import Deque, Dict, Iterable, List, Optional, Tuple
+
+
+class BufferedLogWriter:
+    """Bounded-buffer, batching, size-rotating appender for line-oriented logs"""
+
+    def __init__(self, max_queue: int = 10000, flush_lines: int = 200,
+                 flush_interval: float = 1.0, max_bytes: int = 4 * 1024 * 1024,
+                 backups: int = 1, never_rotate: Iterable[str] = ()):
+        # deque.append/popleft are atomic, so the request path takes no lock
+        self.buffer: Deque[Tuple[str, str]] = deque()
+        self.max_queue = max_queue
+        # A batch is written once flush_lines are pending or flush_interval
+        # seconds have passed since the last write
+        self.flush_lines = flush_lines
+        self.flush_interval = flush_interval
+        # Rotate a file once it grows past max_bytes (0 = never), keeping
+        # path.1 .. path.<backups>
+        self.max_bytes = max_bytes
+        self.backups = backups
+        # Files read by tools that only look at the live file
+        self.never_rotate = set(never_rotate)
+        self.files: Dict[str, object] = {}
+        self.written: Dict[str, int] = {}
+        self.dropped: Dict[str, int] = {}
+        self.rotations: Dict[str, int] = {}
+        self.errors = 0
+        self.flushes = 0
+        self._error: Optional[str] = None
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """Start the writer thread (idempotent)"""
+        if self._thread is None or not self._thread.is_alive():
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name='secubox-logwriter', daemon=True)
+            self._thread.start()
+
+    def write(self, path: str, line: str) -> bool:
+        """Queue one line (without newline) for path; False if it was dropped"""
+        pending = len(self.buffer)
+        if pending >= self.max_queue:
+            self.dropped[path] = self.dropped.get(path, 0) + 1
+            return False
+        self.buffer.append((path, line))
+        if pending + 1 >= self.flush_lines and not self._wake.is_set():
+            self._wake.set()
+        return True
+
+    def take_error(self) -> Optional[str]:
+        """Return and clear the last error raised in the writer thread"""
+        error, self._error = self._error, None
+        return error
+
+    def close(self, timeout: float = 5.0):
+        """Flush pending lines and stop the writer thread"""
+        if self._thread is not None and self._thread.is_alive():
+            self._stopping = True
+            self._wake.set()
+            self._thread.join(timeout)
+        else:
+            self._drain()
+        self._close_files()
+
+    def stats(self) -> dict:
+        """Writer counters for the stats file"""
+        return {
+            'queued': len(self.buffer),
+            'written': dict(self.written),
+            'dropped': dict(self.dropped),
+            'rotations': dict(self.rotations),
+            'flushes': self.flushes,
+            'errors': self.errors,
+        }
+
+    def _run(self):
+        while not self._stopping:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self._drain()
+        self._drain()
+
+    def _drain(self):
+        """Write every line buffered so far"""
+        pending: Dict[str, List[str]] = {}
+        buffer = self.buffer
+        while True:
+            try:
+                path, line = buffer.popleft()
+            except IndexError:
+                break
+            pending.setdefault(path, []).append(line)
+        if pending:
+            self._flush(pending)
+
+    def _open(self, path: str):
+        f = self.files.get(path)
+        if f is not None:
+            # Reopen when the file was removed or rotated by someone else
+            try:
+                if os.stat(path).st_ino == os.fstat(f.fileno()).st_ino:
+                    return f
+            except OSError:
+                pass
+            f.close()
+        f = open(path, 'a')
+        self.files[path] = f
+        return f
+
+    def _flush(self, pending: Dict[str, List[str]]):
+        for path, lines in pending.items():
+            if not lines:
+                continue
+            try:
+                f = self._open(path)
+                f.write('\n'.join(lines) + '\n')
+                f.flush()
+                self.written[path] = self.written.get(path, 0) + len(lines)
+                if self.max_bytes and path not in self.never_rotate and f.tell() >= self.max_bytes:
+                    self._rotate(path)
+            except Exception as e:
+                self.errors += 1
+                self._error = f"{path}: {e}"
+        self.flushes += 1
+
+    def _rotate(self, path: str):
+        """Shift path -> path.1 -> ... -> path.<backups> and start a new file"""
+        f = self.files.pop(path, None)
+        if f is not None:
+            f.close()
+        if self.backups > 0:
+            for i in range(self.backups - 1, 0, -1):
+                src = f"{path}.{i}"
+                if os.path.exists(src):
+                    os.replace(src, f"{path}.{i + 1}")
+            os.replace(path, f"{path}.1")
+        else:
+            open(path, 'w').close()
+        self.rotations[path] = self.rotations.get(path, 0) + 1
+
+    def _close_files(self):
+        for f in self.files.values():
+            try:
+                f.close()
+            except Exception:
+                pass
+        self.files = {}
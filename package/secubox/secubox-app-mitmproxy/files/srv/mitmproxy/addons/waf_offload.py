@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+SecuBox WAF Scan Offload
+Runs the threat scan of large request bodies in worker processes
+mitmproxy handles every flow on one thread, so a regex scan over tens of
+kilobytes of body holds up all other connections and a multi-core router
+uses a single core for WAF work. ScanOffload hands those scans to a pool
+of forked workers while the flow waits in an async hook; the workers
+inherit the compiled rules of the addon at fork time, and the pool is
+replaced whenever the rules or the addon options change
+"""
+
+import asyncio
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Hashable, Optional
+
+from mitmproxy import http
+
+from waf_request import NormalizedRequest
+
+# What happens to a request whose scan could not be offloaded (queue full,
+# worker failure or timeout): scanned without its body, or rejected
+POLICY_OPEN = 'open'
+POLICY_CLOSED = 'closed'
+POLICIES = (POLICY_OPEN, POLICY_CLOSED)
+
+# Scan callable of the pool being started, inherited by its forked workers
+_scan: Optional[Callable[[http.Request], dict]] = None
+
+
+def _run(request: http.Request) -> dict:
+    """Worker side: scan the request with the inherited callable"""
+    return _scan(request)
+
+
+class OffloadError(Exception):
+    """A scan that was not run by a worker; reason is queue_full, timeout or failed"""
+
+    def __init__(self, reason: str, detail: str = ''):
+        super().__init__(f"{reason}: {detail}" if detail else reason)
+        self.reason = reason
+
+
+class ScanOffload:
+    """
+    Process pool for the body scans of large requests.
+
+    A request qualifies when its inspected body text is at least threshold
+    characters. At most queue_depth scans are submitted or running at once
+    (a scan that timed out keeps its worker busy until it finishes). The
+    workers are forked, so the scan callable and everything it uses are
+    the parent's at the time the pool starts; a new generation value
+    starts a new pool. workers=0 disables the offload.
+    """
+
+    def __init__(self, workers: int = 0, threshold: int = 16384, queue_depth: int = 32,
+                 timeout: float = 2.0, policy: str = POLICY_OPEN):
+        self.workers = workers
+        self.threshold = threshold
+        self.queue_depth = queue_depth
+        self.timeout = timeout
+        self.policy = policy
+        self.available = 'fork' in multiprocessing.get_all_start_methods()
+        self.pending = 0
+        self.max_pending = 0
+        self.submitted = 0
+        self.completed = 0
+        self.queue_full = 0
+        self.timeouts = 0
+        self.failures = 0
+        self.pools = 0
+        self.total_ms = 0.0
+        self._lock = threading.Lock()
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._generation: Optional[Hashable] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.workers > 0 and self.available
+
+    def wants(self, view: NormalizedRequest) -> bool:
+        """Whether the body scan of this request goes to the pool"""
+        return self.enabled and len(view.body) >= self.threshold
+
+    async def scan(self, view: NormalizedRequest, scan: Callable[[http.Request], dict],
+                   generation: Hashable) -> dict:
+        """Result of scan(view.request) computed by a worker; raises OffloadError"""
+        with self._lock:
+            if self.pending >= self.queue_depth:
+                self.queue_full += 1
+                raise OffloadError('queue_full')
+            self.pending += 1
+            self.max_pending = max(self.max_pending, self.pending)
+        start = time.perf_counter()
+        try:
+            future = self._pool(scan, generation).submit(_run, view.request)
+        except (BrokenProcessPool, RuntimeError, OSError) as e:
+            self._finished(None)
+            self.failures += 1
+            self.retire()
+            raise OffloadError('failed', str(e))
+        future.add_done_callback(self._finished)
+        self.submitted += 1
+        try:
+            result = await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise OffloadError('timeout', f"{self.timeout}s")
+        except BrokenProcessPool as e:
+            self.failures += 1
+            self.retire()
+            raise OffloadError('failed', str(e) or 'worker died')
+        except Exception as e:
+            self.failures += 1
+            raise OffloadError('failed', f"{type(e).__name__}: {e}")
+        self.completed += 1
+        self.total_ms += (time.perf_counter() - start) * 1000
+        return result
+
+    def _finished(self, future):
+        with self._lock:
+            self.pending -= 1
+
+    def _pool(self, scan: Callable[[http.Request], dict], generation: Hashable) -> ProcessPoolExecutor:
+        if self._executor is not None and generation != self._generation:
+            self.retire()
+        if self._executor is None:
+            global _scan
+            _scan = scan
+            self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context('fork'))
+            self._generation = generation
+            self.pools += 1
+        return self._executor
+
+    def retire(self):
+        """Drop the current pool; running scans finish, the next one forks a new pool"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+            self._generation = None
+
+    def stats(self) -> dict:
+        """Pool counters for the stats file"""
+        return {
+            'enabled': self.enabled,
+            'workers': self.workers,
+            'threshold': self.threshold,
+            'policy': self.policy,
+            'pending': self.pending,
+            'max_pending': self.max_pending,
+            'submitted': self.submitted,
+            'completed': self.completed,
+            'queue_full': self.queue_full,
+            'timeouts': self.timeouts,
+            'failures': self.failures,
+            'pools': self.pools,
+            'mean_ms': round(self.total_ms / self.completed, 2) if self.completed else 0.0,
+        }
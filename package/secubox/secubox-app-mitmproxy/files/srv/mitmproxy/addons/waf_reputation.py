@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+SecuBox WAF Shared IP Reputation
+One reputation table for every mitmproxy instance on the router
+The in (WAF) and out (LAN egress) containers each kept their own threat
+state, so an attacker known to one was a stranger to the other. The table
+lives in a memory-mapped file on a directory both containers (and the
+dpi_buffer addon) bind-mount: a fixed number of fixed-size slots, open
+addressing with a bounded probe, scores that halve every half_life
+seconds, and the lowest-scored entry of the probe window evicted when the
+window is full, so lookups are O(1) and the file never grows
+"""
+
+import fcntl
+import mmap
+import os
+import socket
+import struct
+import time
+import zlib
+from typing import Optional
+
+MAGIC = b'SBXREP1\0'
+# magic, slot count, slot size, slots in use, evictions
+HEADER = struct.Struct('<8sIIII')
+HEADER_SIZE = 64
+# address (IPv6 or IPv4-mapped), score at updated, updated (epoch s), reports
+SLOT = struct.Struct('<16sdII')
+EMPTY = bytes(16)
+# Slots examined for an address before the weakest one is evicted
+PROBE = 8
+
+# Points reported per detection
+SEVERITY_POINTS = {'low': 5, 'medium': 10, 'high': 20, 'critical': 40}
+RATE_LIMIT_POINTS = 5
+BAN_POINTS = 100
+# Score from which an IP is treated as known bad
+BAD_SCORE = 50.0
+MAX_SCORE = 1000.0
+# Source prefixes never reported: LAN and loopback clients are trusted, and
+# a score would tag them on every instance reading the table
+LOCAL_PREFIXES = ('10.', '172.16.', '172.17.', '172.18.', '172.19.',
+                  '172.20.', '172.21.', '172.22.', '172.23.', '172.24.',
+                  '172.25.', '172.26.', '172.27.', '172.28.', '172.29.',
+                  '172.30.', '172.31.', '192.168.', '127.')
+
+
+def ip_key(ip: str) -> Optional[bytes]:
+    """16-byte table key of an address (IPv4 as ::ffff:a.b.c.d), None if invalid"""
+    try:
+        return b'\0' * 10 + b'\xff\xff' + socket.inet_pton(socket.AF_INET, ip)
+    except (OSError, TypeError):
+        pass
+    try:
+        key = socket.inet_pton(socket.AF_INET6, ip.split('%')[0])
+    except (OSError, TypeError, AttributeError):
+        return None
+    return key if key != EMPTY else None
+
+
+class ReputationStore:
+    """
+    Decaying per-IP threat scores in a shared memory-mapped file.
+
+    Processes serialize on an flock() of the file (shared for lookups,
+    exclusive for updates). The first process to open the file sets its
+    slot count (rounded up to a power of two); later ones use what the
+    file says. Decay is applied lazily: a slot keeps its score at its last
+    update and readers scale it by the time elapsed. Any error leaves the
+    store disabled (lookups return 0) with the reason in last_error.
+    """
+
+    def __init__(self, path: str, slots: int = 65536, half_life: float = 3600.0):
+        self.path = path
+        self.slots = 1 << max(slots - 1, 1).bit_length()
+        self.half_life = half_life
+        self.lookups = 0
+        self.reports = 0
+        self.errors = 0
+        self.last_error: Optional[str] = None
+        self._fd: Optional[int] = None
+        self._map: Optional[mmap.mmap] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self._map is not None
+
+    def open(self) -> bool:
+        """Map the table, creating it if needed"""
+        self.close()
+        fd = None
+        try:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                header = os.pread(fd, HEADER.size, 0)
+                if len(header) == HEADER.size and header[:8] == MAGIC:
+                    _, slots, slot_size, _, _ = HEADER.unpack(header)
+                    if slot_size != SLOT.size or slots & (slots - 1):
+                        raise ValueError(f"unsupported table layout ({slots} x {slot_size})")
+                    self.slots = slots
+                else:
+                    os.ftruncate(fd, 0)
+                    os.ftruncate(fd, HEADER_SIZE + self.slots * SLOT.size)
+                    os.pwrite(fd, HEADER.pack(MAGIC, self.slots, SLOT.size, 0, 0), 0)
+                size = HEADER_SIZE + self.slots * SLOT.size
+                if os.fstat(fd).st_size < size:
+                    raise ValueError('table file is truncated')
+                self._map = mmap.mmap(fd, size)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            self._fd = fd
+            return True
+        except (OSError, ValueError) as e:
+            self._error(f"{self.path}: {e}")
+            if fd is not None:
+                os.close(fd)
+            return False
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _decayed(self, score: float, updated: int, now: float) -> float:
+        if self.half_life <= 0 or now <= updated:
+            return score
+        return score * 0.5 ** ((now - updated) / self.half_life)
+
+    def _find(self, key: bytes) -> Optional[int]:
+        mask = self.slots - 1
+        index = zlib.crc32(key) & mask
+        for i in range(PROBE):
+            offset = HEADER_SIZE + ((index + i) & mask) * SLOT.size
+            stored = self._map[offset:offset + 16]
+            if stored == key:
+                return offset
+            if stored == EMPTY:
+                return None
+        return None
+
+    def score(self, ip: str, now: Optional[float] = None) -> float:
+        """Current (decayed) score of ip, 0 if unknown"""
+        if self._map is None:
+            return 0.0
+        key = ip_key(ip)
+        if key is None:
+            return 0.0
+        now = time.time() if now is None else now
+        self.lookups += 1
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_SH)
+            try:
+                offset = self._find(key)
+                if offset is None:
+                    return 0.0
+                _, score, updated, _ = SLOT.unpack_from(self._map, offset)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        except (OSError, ValueError) as e:
+            self._error(str(e))
+            return 0.0
+        return self._decayed(score, updated, now)
+
+    def report(self, ip: str, points: float, now: Optional[float] = None) -> float:
+        """Add points to ip's decayed score; returns the new score"""
+        if self._map is None:
+            return 0.0
+        key = ip_key(ip)
+        if key is None:
+            return 0.0
+        now = time.time() if now is None else now
+        self.reports += 1
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                return self._report(key, points, now)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        except (OSError, ValueError) as e:
+            self._error(str(e))
+            return 0.0
+
+    def _report(self, key: bytes, points: float, now: float) -> float:
+        mask = self.slots - 1
+        index = zlib.crc32(key) & mask
+        victim = victim_score = None
+        for i in range(PROBE):
+            offset = HEADER_SIZE + ((index + i) & mask) * SLOT.size
+            stored, score, updated, count = SLOT.unpack_from(self._map, offset)
+            if stored == key:
+                score = min(self._decayed(score, updated, now) + points, MAX_SCORE)
+                SLOT.pack_into(self._map, offset, key, score, int(now), count + 1)
+                return score
+            if stored == EMPTY:
+                victim, victim_score = offset, None
+                break
+            decayed = self._decayed(score, updated, now)
+            if victim is None or decayed < victim_score:
+                victim, victim_score = offset, decayed
+        # New address: a free slot, or the weakest entry of the window
+        score = min(points, MAX_SCORE)
+        SLOT.pack_into(self._map, victim, key, score, int(now), 1)
+        _, slots, slot_size, used, evictions = HEADER.unpack_from(self._map, 0)
+        if victim_score is None:
+            used += 1
+        else:
+            evictions += 1
+        HEADER.pack_into(self._map, 0, MAGIC, slots, slot_size, used, evictions)
+        return score
+
+    def _error(self, message: str):
+        self.errors += 1
+        self.last_error = message
+
+    def stats(self) -> dict:
+        """Table occupancy (shared) and this process's counters"""
+        used = evictions = 0
+        if self._map is not None:
+            _, _, _, used, evictions = HEADER.unpack_from(self._map, 0)
+        return {
+            'enabled': self.enabled,
+            'path': self.path,
+            'slots': self.slots,
+            'used': used,
+            'evictions': evictions,
+            'half_life': self.half_life,
+            'lookups': self.lookups,
+            'reports': self.reports,
+            'errors': self.errors,
+            'last_error': self.last_error,
+        }
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+SecuBox WAF Request View
+Normalized per-flow request representation shared by all detectors
+Built once in SecuBoxAnalytics.request() and kept in flow.metadata, so the
+path, URL, body and headers are decoded and lowercased a single time
+"""
+
+import json
+import unicodedata
+from functools import cached_property
+from typing import Dict, List, Optional
+from urllib.parse import parse_qsl, unquote
+
+from mitmproxy import http
+
+from waf_inspect import BodyInspector, InspectedBody
+
+# flow.metadata key holding the NormalizedRequest for the flow
+VIEW_KEY = 'secubox_view'
+
+# Inspector used when the caller does not pass its own
+_DEFAULT_INSPECTOR = BodyInspector()
+
+
+def _nfkc(text: str) -> str:
+    """NFKC-normalize text, skipping the work for plain ASCII"""
+    return text if text.isascii() else unicodedata.normalize('NFKC', text)
+
+
+def _flatten_json(value, out: List[str]):
+    """Collect keys and scalar values of a decoded JSON document"""
+    if isinstance(value, dict):
+        for k, v in value.items():
+            out.append(str(k).lower())
+            _flatten_json(v, out)
+    elif isinstance(value, list):
+        for v in value:
+            _flatten_json(v, out)
+    elif value is not None:
+        out.append(str(value).lower())
+
+
+class NormalizedRequest:
+    """
+    Lowercased and decoded views of an HTTP request.
+
+    The raw (still percent-encoded) lowercased views are what the detection
+    patterns are written against. The URL-decoded, NFKC-normalized path and
+    field values are added to combined when they differ from the raw text, so
+    %2e%2e-style and fullwidth evasions meet the same patterns; they and the
+    parsed form/JSON fields are computed on first access. The body text is
+    what a BodyInspector selected for the Content-Type; content_length always
+    reports the full size. With inspect_body=False (load shedding) the body
+    is not decoded at all and every view sees an empty body.
+    """
+
+    def __init__(self, request: http.Request, inspector: Optional[BodyInspector] = None,
+                 inspect_body: bool = True):
+        self.request = request
+        self.headers = request.headers
+        self.method = request.method
+        self.host = request.host
+        self.raw_path = request.path
+        self.path = self.raw_path.lower()
+        self.full_url = request.pretty_url.lower()
+        self.content = request.content or b''
+        self.content_length = len(self.content)
+        raw_type = self.headers.get('content-type', '')
+        self.content_type = raw_type.lower()
+        if inspect_body:
+            inspected = (inspector or _DEFAULT_INSPECTOR).inspect(self.content, raw_type)
+        else:
+            inspected = InspectedBody('', 'shed', 0, self.content_length)
+        self.body = inspected.text
+        self.body_strategy = inspected.strategy
+        self.body_inspected = inspected.inspected
+        self.body_skipped = inspected.skipped
+        self.user_agent = self.headers.get('user-agent', '')
+        self.ua_lower = self.user_agent.lower()
+
+        self.query = request.query
+        self.query_values: List[str] = [str(v) for v in self.query.values()] if self.query else []
+
+        # Path, full URL, body and query values - the text most categories scan
+        self.combined = ' '.join([self.path, self.full_url, self.body] + self.query_values
+                                 + self.body_values + self.decoded_views)
+
+    @classmethod
+    def for_flow(cls, flow: http.HTTPFlow, inspector: Optional[BodyInspector] = None,
+                 inspect_body: bool = True) -> 'NormalizedRequest':
+        """Return the view stored on the flow, building it on first use"""
+        view = flow.metadata.get(VIEW_KEY)
+        if view is None or view.request is not flow.request:
+            view = cls(flow.request, inspector, inspect_body)
+            flow.metadata[VIEW_KEY] = view
+        return view
+
+    @property
+    def body_values(self) -> List[str]:
+        """
+        Decoded form/JSON field values, when decoding changes the raw text.
+
+        Patterns are written against the raw body, so the values are only
+        worth scanning when percent/plus or JSON escapes hid something.
+        """
+        if self.body_strategy == 'form' and ('%' in self.body or '+' in self.body):
+            return [v for vs in self.form_fields.values() for v in vs]
+        if self.body_strategy == 'json' and '\\' in self.body:
+            return self.json_fields
+        return []
+
+    @property
+    def decoded_views(self) -> List[str]:
+        """
+        Decoded path and field values, when decoding changes the raw text.
+
+        Percent escapes in the path and non-ASCII text (which NFKC may fold to
+        ASCII, e.g. fullwidth '＜' to '<') are the only cases where they do.
+        """
+        views = []
+        if '%' in self.raw_path or not self.raw_path.isascii():
+            if self.normalized_path != self.path:
+                views.append(self.normalized_path)
+        if not self.body.isascii() or not all(v.isascii() for v in self.query_values):
+            views.append(self.decoded_fields)
+        return views
+
+    @property
+    def body_report(self) -> Dict[str, object]:
+        """Strategy and byte counts of the body inspection, for the log entry"""
+        return {'strategy': self.body_strategy, 'inspected': self.body_inspected, 'skipped': self.body_skipped}
+
+    @cached_property
+    def ssrf_combined(self) -> str:
+        """Body and query values - SSRF targets exclude the requested URL itself"""
+        return ' '.join([self.body] + self.query_values + self.body_values)
+
+    @cached_property
+    def headers_str(self) -> str:
+        """All headers as lowercased 'name: value' pairs"""
+        return ' '.join(f"{k}: {v}" for k, v in self.headers.items()).lower()
+
+    @cached_property
+    def normalized_path(self) -> str:
+        """Percent-decoded, NFKC-normalized, lowercased path"""
+        return _nfkc(unquote(self.raw_path)).lower()
+
+    @cached_property
+    def query_fields(self) -> Dict[str, List[str]]:
+        """Parsed query parameters (lowercased values)"""
+        fields: Dict[str, List[str]] = {}
+        if self.query:
+            for k, v in self.query.items(multi=True):
+                fields.setdefault(k.lower(), []).append(str(v).lower())
+        return fields
+
+    @cached_property
+    def form_fields(self) -> Dict[str, List[str]]:
+        """Parsed application/x-www-form-urlencoded body fields"""
+        fields: Dict[str, List[str]] = {}
+        if self.body and 'application/x-www-form-urlencoded' in self.content_type:
+            for k, v in parse_qsl(self.body, keep_blank_values=True):
+                fields.setdefault(k, []).append(v)
+        return fields
+
+    @cached_property
+    def json_fields(self) -> List[str]:
+        """Keys and scalar values of a JSON body, lowercased"""
+        out: List[str] = []
+        if self.body and 'json' in self.content_type:
+            try:
+                _flatten_json(json.loads(self.body), out)
+            except ValueError:
+                pass
+        return out
+
+    @cached_property
+    def decoded_fields(self) -> str:
+        """Query, form and JSON field values (already URL-decoded), NFKC-normalized"""
+        values = [v for vs in self.query_fields.values() for v in vs]
+        values.extend(v for vs in self.form_fields.values() for v in vs)
+        values.extend(self.json_fields)
+        return _nfkc(' '.join(values)).lower()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+SecuBox WAF Access-Log Sampling
+Every request used to write a full JSON line to the access log, so a
+traffic spike of clean requests turned straight into disk writes on flash
+LogSampler keeps every request worth looking at and, once clean traffic
+goes past a per-second budget, one clean request in k, where k follows
+the clean request rate. Kept lines carry sample_weight k so that counts
+summed over the log still match the traffic
+"""
+
+import math
+import time
+from typing import Optional
+
+
+class LogSampler:
+    """
+    Systematic 1-in-k sampling of clean requests with k adapted to volume.
+
+    The clean request rate is measured over UPDATE_INTERVAL windows (cut
+    short when a window already holds a second's worth of lines at the
+    current k) and smoothed; k is the rate divided by budget (clean lines
+    per second), rounded up, so the clean lines written stay near budget
+    whatever the traffic. keep() returns the weight of a kept request (1 below the
+    budget) or 0 for a request left out. budget=0 keeps every request.
+    """
+
+    # Seconds between rate updates
+    UPDATE_INTERVAL = 1.0
+    # Smoothing of the clean request rate
+    ALPHA = 0.5
+
+    def __init__(self, budget: float = 50.0):
+        self.budget = budget
+        self.rate: Optional[float] = None
+        self.every = 1
+        self.kept = 0
+        self.skipped = 0
+        self.always = 0
+        self._countdown = 0
+        self._window_start: Optional[float] = None
+        self._window_count = 0
+
+    def keep(self, interesting: bool, now: Optional[float] = None) -> int:
+        """Sample weight of this request's log line, 0 to leave it out"""
+        if interesting:
+            self.always += 1
+            return 1
+        if self.budget <= 0:
+            self.kept += 1
+            return 1
+        now = time.monotonic() if now is None else now
+        self._window_count += 1
+        if self._window_start is None:
+            self._window_start = now
+        elif (now - self._window_start >= self.UPDATE_INTERVAL
+              # A surge updates early, once the window holds a second's worth of lines
+              or (self._window_count >= self.budget * self.every and now > self._window_start)):
+            self._update(now)
+        # The first request of each run of k is kept and stands for all k
+        if self._countdown > 0:
+            self._countdown -= 1
+            self.skipped += 1
+            return 0
+        self._countdown = self.every - 1
+        self.kept += 1
+        return self.every
+
+    def _update(self, now: float):
+        sample = self._window_count / (now - self._window_start)
+        self.rate = sample if self.rate is None else self.rate + self.ALPHA * (sample - self.rate)
+        self._window_start = now
+        self._window_count = 0
+        self.every = max(1, math.ceil(self.rate / self.budget))
+
+    def stats(self) -> dict:
+        """Sampler state for the stats file"""
+        return {
+            'budget': self.budget,
+            'clean_rate': round(self.rate or 0.0, 1),
+            'every': self.every,
+            'kept': self.kept,
+            'skipped': self.skipped,
+            'always': self.always,
+        }
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+SecuBox WAF Load Shedding
+Detection runs inside mitmproxy's asyncio loop, so under a flood its cost
+is added to the latency of every connection the proxy carries
+LoadShedder watches the event-loop lag and the share of loop time spent in
+detection, steps down through cheaper detection tiers while either stays
+too high and steps back up once both have been low for a while
+"""
+
+import asyncio
+import time
+from typing import List, Optional, Tuple
+
+# Detection tiers, cheapest last
+TIER_FULL = 0       # every detector, request body included
+TIER_REDUCED = 1    # path, query and header checks with the prefilter, no body
+TIER_MINIMAL = 2    # rate limiting and IP reputation only
+TIERS = ('full', 'reduced', 'minimal')
+
+
+def _ewma(current: float, sample: float, alpha: float) -> float:
+    return sample if current is None else current + alpha * (sample - current)
+
+
+class LoadShedder:
+    """
+    Tier controller fed by request timings and an event-loop lag probe.
+
+    Pressure is an event-loop lag above lag_ms, or detection using more
+    than busy of the loop's time (request rate x mean detection time at the
+    current tier). Pressure sustained for hold seconds steps one tier down.
+    The controller steps one tier up after recover seconds with the lag
+    under half of lag_ms and the predicted busy share of the richer tier
+    (its mean time at the current rate) under half of busy. While the lag
+    is low, one request in PROBE_EVERY is processed at the richer tier so
+    its mean time follows the current traffic.
+    """
+
+    # Seconds between controller updates (request rate window)
+    UPDATE_INTERVAL = 0.5
+    # Smoothing of the lag, rate and per-tier time averages
+    ALPHA = 0.3
+    # Shed requests between two probes of the next richer tier
+    PROBE_EVERY = 20
+
+    def __init__(self, lag_ms: float = 100.0, busy: float = 0.5, hold: float = 1.0,
+                 recover: float = 10.0, enabled: bool = True):
+        self.enabled = enabled
+        self.lag_ms = lag_ms
+        self.busy = busy
+        self.hold = hold
+        self.recover = recover
+        self.tier = TIER_FULL
+        self.lag: Optional[float] = None
+        self.max_lag = 0.0
+        self.rate: Optional[float] = None
+        self.cost_ms: List[Optional[float]] = [None] * len(TIERS)
+        self.requests = [0] * len(TIERS)
+        self.changes = 0
+        self.probes = 0
+        self.changed_at = time.monotonic()
+        self._window_start: Optional[float] = None
+        self._window_count = 0
+        self._pressure_since: Optional[float] = None
+        self._calm_since: Optional[float] = None
+        self._change: Optional[Tuple[int, int]] = None
+
+    def begin(self, now: Optional[float] = None) -> int:
+        """Tier the next request is processed at"""
+        if not self.enabled:
+            if self.tier != TIER_FULL:
+                self._set(TIER_FULL, time.monotonic())
+            self.requests[TIER_FULL] += 1
+            return TIER_FULL
+        now = time.monotonic() if now is None else now
+        self._window_count += 1
+        if self._window_start is None:
+            self._window_start = now
+        elif now - self._window_start >= self.UPDATE_INTERVAL:
+            self._update(now)
+        tier = self.tier
+        if (tier > TIER_FULL and (self.lag or 0.0) < self.lag_ms / 2
+                and self.requests[tier] % self.PROBE_EVERY == self.PROBE_EVERY - 1):
+            self.probes += 1
+            tier -= 1
+        self.requests[tier] += 1
+        return tier
+
+    def end(self, tier: int, elapsed_ms: float):
+        """Detection time of a request processed at tier"""
+        self.cost_ms[tier] = _ewma(self.cost_ms[tier], elapsed_ms, self.ALPHA)
+
+    def record_lag(self, lag_ms: float):
+        """One event-loop lag sample (how late a timer fired)"""
+        self.lag = _ewma(self.lag, lag_ms, self.ALPHA)
+        self.max_lag = max(self.max_lag, lag_ms)
+
+    def busy_share(self, tier: int) -> float:
+        """Predicted share of loop time detection takes at tier and the current rate"""
+        cost = self.cost_ms[tier]
+        if not self.rate or cost is None:
+            return 0.0
+        return self.rate * cost / 1000.0
+
+    def _update(self, now: float):
+        self.rate = _ewma(self.rate, self._window_count / (now - self._window_start), self.ALPHA)
+        self._window_start = now
+        self._window_count = 0
+        lag = self.lag or 0.0
+
+        if lag > self.lag_ms or self.busy_share(self.tier) > self.busy:
+            self._calm_since = None
+            if self._pressure_since is None:
+                self._pressure_since = now
+            if self.tier < TIER_MINIMAL and now - self._pressure_since >= self.hold:
+                self._set(self.tier + 1, now)
+            return
+        self._pressure_since = None
+
+        if (self.tier > TIER_FULL and lag < self.lag_ms / 2
+                and self.busy_share(self.tier - 1) < self.busy / 2):
+            if self._calm_since is None:
+                self._calm_since = now
+            if now - self._calm_since >= self.recover:
+                self._set(self.tier - 1, now)
+        else:
+            self._calm_since = None
+
+    def _set(self, tier: int, now: float):
+        self._change = (self.tier, tier)
+        self.tier = tier
+        self.changes += 1
+        self.changed_at = now
+        self._pressure_since = None
+        self._calm_since = None
+
+    def take_change(self) -> Optional[Tuple[str, str]]:
+        """Return and clear the last (from, to) tier change"""
+        change, self._change = self._change, None
+        return (TIERS[change[0]], TIERS[change[1]]) if change else None
+
+    async def monitor(self, interval: float = 0.25):
+        """Sample the event-loop lag until cancelled"""
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            self.record_lag(max(0.0, (loop.time() - start - interval) * 1000))
+
+    def stats(self) -> dict:
+        """Controller state for the stats file"""
+        return {
+            'enabled': self.enabled,
+            'tier': TIERS[self.tier],
+            'lag_ms': round(self.lag or 0.0, 1),
+            'max_lag_ms': round(self.max_lag, 1),
+            'rate': round(self.rate or 0.0, 1),
+            'busy': round(self.busy_share(self.tier), 3),
+            'detection_ms': {name: round(cost, 3) for name, cost in zip(TIERS, self.cost_ms) if cost is not None},
+            'requests': dict(zip(TIERS, self.requests)),
+            'changes': self.changes,
+            'probes': self.probes,
+        }
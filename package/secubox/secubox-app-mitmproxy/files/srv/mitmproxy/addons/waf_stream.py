@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+SecuBox WAF Response Streaming
+The analytics addon only logs the size of a response, but reading
+response.content for it makes mitmproxy buffer the whole body and decode
+its Content-Encoding first - for downloads and video that is memory and
+time to first byte spent on one number. When enabled (secubox_stream),
+ResponseStreamer streams large and media responses through a byte counter;
+in wire mode it takes the size of the others from the raw body or the
+Content-Length header. Both are off by default: responses are buffered and
+their decoded size is logged, as before
+"""
+
+from typing import Optional, Tuple
+
+from mitmproxy import http
+
+# How response sizes are logged
+SIZE_WIRE = 'wire'          # bytes as received: counted, raw body or Content-Length
+SIZE_DECODED = 'decoded'    # decoded body length (buffers and decompresses)
+SIZE_MODES = (SIZE_WIRE, SIZE_DECODED)
+
+
+def parse_types(value: str) -> Tuple[str, ...]:
+    """Content-Type prefixes from a comma-separated option value"""
+    return tuple(t.strip().lower() for t in value.split(',') if t.strip())
+
+
+class ByteCounter:
+    """response.stream callable: passes chunks through and counts them"""
+
+    __slots__ = ('bytes',)
+
+    def __init__(self):
+        self.bytes = 0
+
+    def __call__(self, chunk: bytes) -> bytes:
+        self.bytes += len(chunk)
+        return chunk
+
+
+class ResponseStreamer:
+    """
+    Streaming decision and size accounting for responses.
+
+    Nothing is streamed unless enabled. Then a response is streamed when
+    its Content-Type starts with one of types
+    or its Content-Length is at least min_bytes (min_bytes=0 disables the
+    size rule, an empty types tuple the type rule); a response another
+    addon already streams is left alone. Streamed bodies are never held
+    by mitmproxy, so their size is the count of bytes passed through.
+    """
+
+    def __init__(self, types: Tuple[str, ...] = ('video/', 'audio/', 'application/octet-stream'),
+                 min_bytes: int = 1024 * 1024, mode: str = SIZE_DECODED, enabled: bool = False):
+        self.enabled = enabled
+        self.types = types
+        self.min_bytes = min_bytes
+        self.mode = mode
+        self.streamed = 0
+        self.buffered = 0
+        self.streamed_bytes = 0
+
+    @staticmethod
+    def declared_length(response: http.Response) -> Optional[int]:
+        try:
+            return int(response.headers.get('content-length', ''))
+        except ValueError:
+            return None
+
+    def wants(self, response: http.Response) -> bool:
+        if not self.enabled or response.stream:
+            return False
+        length = self.declared_length(response)
+        if length == 0:
+            return False
+        if self.min_bytes > 0 and length is not None and length >= self.min_bytes:
+            return True
+        return bool(self.types) and response.headers.get('content-type', '').lower().startswith(self.types)
+
+    def begin(self, response: http.Response) -> bool:
+        """responseheaders step: stream the body through a counter if it qualifies"""
+        if not self.wants(response):
+            return False
+        response.stream = ByteCounter()
+        self.streamed += 1
+        return True
+
+    def size(self, response: http.Response) -> int:
+        """Body size of a finished response, without decoding it in wire mode"""
+        if isinstance(response.stream, ByteCounter):
+            self.streamed_bytes += response.stream.bytes
+            return response.stream.bytes
+        self.buffered += 1
+        if self.mode == SIZE_DECODED:
+            return len(response.content) if response.content else 0
+        if response.raw_content is not None:
+            return len(response.raw_content)
+        return self.declared_length(response) or 0
+
+    def stats(self) -> dict:
+        """Streaming counters for the stats file"""
+        return {
+            'enabled': self.enabled,
+            'mode': self.mode,
+            'types': list(self.types),
+            'min_bytes': self.min_bytes,
+            'streamed': self.streamed,
+            'buffered': self.buffered,
+            'streamed_bytes': self.streamed_bytes,
+        }
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+SecuBox WAF Statistics Time Series
+Per-minute request, bot and threat counters with fixed retention
+Each minute is one JSON line appended to the series file when it closes,
+so a write costs one bucket whatever the uptime, and the file is rewritten
+(atomically) only to drop buckets past the retention. Minutes without
+traffic are not stored; readers treat them as zero
+"""
+
+import json
+import os
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional
+
+BUCKET_SECONDS = 60
+
+# Counters of a bucket ("t" is the start of the minute, epoch seconds)
+COUNTERS = ('requests', 'bots', 'auth_attempts', 'threats')
+# Per-key breakdowns of a bucket, at most MAX_KEYS keys each plus "other"
+BREAKDOWNS = ('threat_types', 'threat_categories', 'threat_countries', 'countries')
+MAX_KEYS = 32
+
+
+def _new_bucket(start: int) -> dict:
+    bucket = {'t': start}
+    for name in COUNTERS:
+        bucket[name] = 0
+    for name in BREAKDOWNS:
+        bucket[name] = {}
+    return bucket
+
+
+def _merge(into: dict, bucket: dict, max_keys: int = 0):
+    """Add bucket to into; with max_keys, keys past it add up under other"""
+    for name in COUNTERS:
+        into[name] = into.get(name, 0) + bucket.get(name, 0)
+    for name in BREAKDOWNS:
+        target = into.setdefault(name, {})
+        for key, count in (bucket.get(name) or {}).items():
+            if max_keys and key not in target and len(target) >= max_keys:
+                key = 'other'
+            target[key] = target.get(key, 0) + count
+
+
+class StatsSeries:
+    """Rolling per-minute buckets, persisted as JSON lines"""
+
+    def __init__(self, path: str, retention: int = 1440):
+        self.path = path
+        # Minutes kept, in memory and in the file
+        self.retention = retention
+        self.buckets: Deque[dict] = deque()
+        self.current: Optional[dict] = None
+        # Sums of the minutes closed since start, breakdowns capped like a bucket
+        self.totals = _new_bucket(int(time.time()))
+        self.lines = 0
+        self.appends = 0
+        self.compactions = 0
+        self.errors = 0
+        self.last_error: Optional[str] = None
+
+    def load(self, now: Optional[float] = None):
+        """Read the retained buckets back and compact the file"""
+        now = time.time() if now is None else now
+        minute = int(now) - int(now) % BUCKET_SECONDS
+        by_start: Dict[int, dict] = {}
+        try:
+            with open(self.path, 'r') as f:
+                for line in f:
+                    try:
+                        bucket = json.loads(line)
+                        start = int(bucket['t'])
+                    except (ValueError, KeyError, TypeError):
+                        continue
+                    # A minute written twice (restart within it) is summed
+                    if start in by_start:
+                        _merge(by_start[start], bucket)
+                    else:
+                        by_start[start] = bucket
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            self._error(f"Error reading {self.path}: {e}")
+        horizon = minute - self.retention * BUCKET_SECONDS
+        self.buckets = deque(by_start[t] for t in sorted(by_start) if horizon < t < minute)
+        # The minute still running continues in memory
+        self.current = by_start.get(minute)
+        self._compact()
+
+    def record(self, ts: int, country: str, is_bot: bool, is_auth: bool,
+               threat_type: Optional[str], category: Optional[str]):
+        """Count one request in the bucket of ts"""
+        bucket = self._bucket(ts)
+        bucket['requests'] += 1
+        self._count(bucket['countries'], country)
+        if is_bot:
+            bucket['bots'] += 1
+        if is_auth:
+            bucket['auth_attempts'] += 1
+        if threat_type:
+            bucket['threats'] += 1
+            self._count(bucket['threat_types'], threat_type)
+            self._count(bucket['threat_countries'], country)
+        if category:
+            self._count(bucket['threat_categories'], category)
+
+    def tick(self, now: Optional[float] = None):
+        """Close the current bucket once its minute is over (no traffic needed)"""
+        now = time.time() if now is None else now
+        if self.current is not None and int(now) - self.current['t'] >= BUCKET_SECONDS:
+            self._close()
+
+    def flush(self):
+        """Persist the open bucket (shutdown); a restart in the same minute merges it"""
+        if self.current is not None:
+            self._close()
+
+    def window(self, minutes: int, now: Optional[float] = None) -> dict:
+        """Sum of the buckets of the last minutes (the open one included)"""
+        now = time.time() if now is None else now
+        since = int(now) - int(now) % BUCKET_SECONDS - (minutes - 1) * BUCKET_SECONDS
+        total = _new_bucket(since)
+        for bucket in reversed(self.buckets):
+            if bucket['t'] < since:
+                break
+            _merge(total, bucket)
+        if self.current is not None and self.current['t'] >= since:
+            _merge(total, self.current)
+        total['minutes'] = minutes
+        return total
+
+    def since_start(self) -> dict:
+        """Counters since the store was created (the open minute included)"""
+        total = _new_bucket(self.totals['t'])
+        _merge(total, self.totals)
+        if self.current is not None:
+            _merge(total, self.current, MAX_KEYS)
+        return total
+
+    def series(self, minutes: Optional[int] = None) -> List[dict]:
+        """Closed buckets, oldest first, optionally only the last minutes"""
+        buckets = list(self.buckets)
+        if minutes is not None and buckets:
+            since = buckets[-1]['t'] - (minutes - 1) * BUCKET_SECONDS
+            buckets = [b for b in buckets if b['t'] >= since]
+        return buckets
+
+    @staticmethod
+    def _count(counts: Dict[str, int], key: str):
+        key = key or 'unknown'
+        if key in counts or len(counts) < MAX_KEYS:
+            counts[key] = counts.get(key, 0) + 1
+        else:
+            counts['other'] = counts.get('other', 0) + 1
+
+    def _bucket(self, ts: int) -> dict:
+        start = int(ts) - int(ts) % BUCKET_SECONDS
+        if self.current is not None and start > self.current['t']:
+            self._close()
+        if self.current is None:
+            self.current = _new_bucket(start)
+        # A late entry (clock step back) is counted in the open minute
+        return self.current
+
+    def _close(self):
+        bucket, self.current = self.current, None
+        self.buckets.append(bucket)
+        _merge(self.totals, bucket, MAX_KEYS)
+        horizon = bucket['t'] - self.retention * BUCKET_SECONDS
+        while self.buckets and self.buckets[0]['t'] <= horizon:
+            self.buckets.popleft()
+        try:
+            # One write() of one line on an O_APPEND descriptor - readers
+            # never see a partial bucket
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, (json.dumps(bucket, separators=(',', ':')) + '\n').encode())
+            finally:
+                os.close(fd)
+            self.lines += 1
+            self.appends += 1
+        except OSError as e:
+            self._error(f"Error appending to {self.path}: {e}")
+        # The file may hold up to twice the retention before it is rewritten
+        if self.lines > 2 * max(self.retention, 1):
+            self._compact()
+
+    def _compact(self):
+        """Rewrite the file with the retained buckets only (tmp file + rename)"""
+        tmp = f"{self.path}.tmp"
+        try:
+            with open(tmp, 'w') as f:
+                for bucket in self.buckets:
+                    f.write(json.dumps(bucket, separators=(',', ':')) + '\n')
+            os.replace(tmp, self.path)
+            self.lines = len(self.buckets)
+            self.compactions += 1
+        except OSError as e:
+            self._error(f"Error writing {self.path}: {e}")
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+
+    def _error(self, message: str):
+        self.errors += 1
+        self.last_error = message
+
+    def stats(self) -> dict:
+        """Store counters for the stats file"""
+        return {
+            'path': self.path,
+            'retention_minutes': self.retention,
+            'buckets': len(self.buckets),
+            'file_lines': self.lines,
+            'appends': self.appends,
+            'compactions': self.compactions,
+            'errors': self.errors,
+            'last_error': self.last_error,
+        }
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""
+SecuBox Per-IP State Tracking
+Fixed-memory tables for the rate limiter, threat attempt history and
+auto-ban bookkeeping of the analytics addon
+Every table holds at most `capacity` source IPs; the least recently seen
+entry is evicted first and entries idle for longer than `ttl` are dropped,
+so an internet-wide scan of one-shot IPs cannot grow memory without bound
+LRUCache memoizes per-request lookups (GeoIP country, UA fingerprint)
+"""
+
+import sys
+import time
+from collections import OrderedDict
+from typing import Callable, List, Optional, Tuple
+
+
+class IPTable:
+    """Per-IP values in LRU order with capacity and idle-time eviction"""
+
+    def __init__(self, name: str, capacity: int = 16384, ttl: float = 3600):
+        self.name = name
+        self.capacity = capacity
+        self.ttl = ttl
+        # ip -> [last_seen, value], least recently seen first
+        self._data: 'OrderedDict[str, list]' = OrderedDict()
+        self.evicted_lru = 0
+        self.evicted_idle = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, ip: str) -> bool:
+        return self.get(ip) is not None
+
+    def get(self, ip: str, now: Optional[float] = None):
+        """Return the live value for ip (refreshing its position), or None"""
+        slot = self._data.get(ip)
+        if slot is None:
+            return None
+        now = time.time() if now is None else now
+        if now - slot[0] > self.ttl:
+            del self._data[ip]
+            self.evicted_idle += 1
+            return None
+        slot[0] = now
+        self._data.move_to_end(ip)
+        return slot[1]
+
+    def setdefault(self, ip: str, factory: Callable[[], object], now: Optional[float] = None):
+        """Return the value for ip, creating it with factory() when missing"""
+        now = time.time() if now is None else now
+        value = self.get(ip, now)
+        if value is None:
+            value = factory()
+            self._data[ip] = [now, value]
+            self._evict(now)
+        return value
+
+    def add(self, ip: str, now: Optional[float] = None):
+        """Set-style insert (value True)"""
+        self.setdefault(ip, lambda: True, now)
+
+    def pop(self, ip: str):
+        slot = self._data.pop(ip, None)
+        return slot[1] if slot is not None else None
+
+    def _evict(self, now: float):
+        data = self._data
+        # Oldest entries sit at the front: drop them while idle, then trim
+        # to capacity. Each insert removes at most what it added plus
+        # already-expired entries, so the cost stays amortized O(1)
+        while data:
+            slot = next(iter(data.values()))
+            if now - slot[0] <= self.ttl:
+                break
+            data.popitem(last=False)
+            self.evicted_idle += 1
+        while len(data) > self.capacity:
+            data.popitem(last=False)
+            self.evicted_lru += 1
+
+    def approx_bytes(self, sample: int = 32) -> int:
+        """Rough memory footprint, extrapolated from a sample of entries"""
+        data = self._data
+        size = sys.getsizeof(data)
+        if not data:
+            return size
+        taken = 0
+        sampled = 0
+        for ip, slot in data.items():
+            value = slot[1]
+            taken += sys.getsizeof(ip) + sys.getsizeof(slot) + sys.getsizeof(value)
+            if isinstance(value, (list, tuple)):
+                taken += sum(sys.getsizeof(v) for v in value)
+            sampled += 1
+            if sampled >= sample:
+                break
+        return size + taken * len(data) // sampled
+
+    def stats(self) -> dict:
+        """Table counters for the stats file"""
+        return {
+            'entries': len(self._data),
+            'capacity': self.capacity,
+            'ttl': self.ttl,
+            'evicted_lru': self.evicted_lru,
+            'evicted_idle': self.evicted_idle,
+            'approx_kb': self.approx_bytes() // 1024,
+        }
+
+
+class SlidingWindowLimiter:
+    """
+    Approximate sliding-window request counter per IP.
+
+    Each IP keeps the count of the current fixed window and of the previous
+    one; the previous count is weighted by how much of it still overlaps the
+    sliding window. Two integers per IP, O(1) per request.
+    """
+
+    def __init__(self, table: IPTable):
+        self.table = table
+
+    def hit(self, ip: str, window: float = 60, now: Optional[float] = None) -> int:
+        """Count one request from ip and return the estimated count in the window"""
+        now = time.time() if now is None else now
+        # [start of current window, current count, previous count]
+        slot = self.table.setdefault(ip, lambda: [now - now % window, 0, 0], now)
+        start = now - now % window
+        if start != slot[0]:
+            slot[2] = slot[1] if start - slot[0] == window else 0
+            slot[0] = start
+            slot[1] = 0
+        slot[1] += 1
+        overlap = 1.0 - (now - start) / window
+        return slot[1] + int(slot[2] * overlap)
+
+
+class AttemptTracker:
+    """
+    Last `history` threat attempts per IP as (timestamp, severity, reason).
+
+    history must cover the largest auto-ban threshold. A short list per IP
+    rather than a deque: most tracked IPs only ever have one attempt.
+    """
+
+    def __init__(self, table: IPTable, history: int = 16):
+        self.table = table
+        self.history = history
+
+    def record(self, ip: str, severity: str, reason: str, now: Optional[float] = None):
+        now = time.time() if now is None else now
+        attempts = self.table.setdefault(ip, list, now)
+        attempts.append((now, severity, reason))
+        if len(attempts) > self.history:
+            del attempts[:-self.history]
+
+    def recent(self, ip: str, window: float, now: Optional[float] = None) -> List[Tuple[float, str, str]]:
+        """Attempts by ip within the last window seconds, oldest first"""
+        now = time.time() if now is None else now
+        attempts: Optional[list] = self.table.get(ip, now)
+        if not attempts:
+            return []
+        stale = 0
+        while stale < len(attempts) and now - attempts[stale][0] >= window:
+            stale += 1
+        if stale:
+            del attempts[:stale]
+        return list(attempts)
+
+
+class LRUCache:
+    """Size-bounded memoization table with hit-rate counters"""
+
+    def __init__(self, name: str, capacity: int = 4096):
+        self.name = name
+        self.capacity = capacity
+        self._data: 'OrderedDict[object, object]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key) -> bool:
+        return key in self._data
+
+    def get(self, key, compute: Callable[[], object]):
+        """Return the cached value for key, calling compute() on a miss"""
+        data = self._data
+        try:
+            value = data[key]
+        except KeyError:
+            self.misses += 1
+            value = compute()
+            if self.capacity > 0:
+                data[key] = value
+                while len(data) > self.capacity:
+                    data.popitem(last=False)
+                    self.evictions += 1
+            return value
+        self.hits += 1
+        data.move_to_end(key)
+        return value
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self) -> dict:
+        """Cache counters for the stats file"""
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._data),
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+        }
@@ -0,0 +1,226 @@
+"""
+BanDispatcher against a stand-in CrowdSec LAPI (http.server), over TCP and
+over a unix socket
+Run: python3 -m pytest tests/test_waf_bans.py
+"""
+
+import asyncio
+import json
+import os
+import socketserver
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'files', 'srv', 'mitmproxy', 'addons'))
+
+from waf_bans import BanDispatcher  # noqa: E402
+
+
+class FakeLAPI:
+    """
+    Records the calls it gets. login_status and alert_status are lists of
+    HTTP statuses answered in turn (the last one repeats).
+    """
+
+    def __init__(self):
+        self.login_status = [200]
+        self.alert_status = [200]
+        self.logins = []
+        self.posts = []
+        self.tokens = 0
+
+    def answer(self, handler):
+        length = int(handler.headers.get('Content-Length', 0))
+        body = json.loads(handler.rfile.read(length) or b'null')
+        if handler.path == '/v1/watchers/login':
+            self.logins.append(body)
+            status = self._next(self.login_status)
+            self.tokens += 1
+            payload = {'token': f"token-{self.tokens}"} if status == 200 else {'message': 'denied'}
+        elif handler.path == '/v1/alerts':
+            self.posts.append({'auth': handler.headers.get('Authorization'), 'alerts': body})
+            status = self._next(self.alert_status)
+            payload = [str(i) for i in range(len(body))] if status in (200, 201) else {'message': 'no'}
+        else:
+            status, payload = 404, {'message': 'not found'}
+        data = json.dumps(payload).encode()
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    @staticmethod
+    def _next(statuses):
+        return statuses.pop(0) if len(statuses) > 1 else statuses[0]
+
+    def banned(self):
+        return [a['source']['value'] for post in self.posts for a in post['alerts']]
+
+
+def make_handler(lapi):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            lapi.answer(self)
+
+        def address_string(self):
+            # A unix socket peer has no address
+            return 'lapi-client'
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+@pytest.fixture(params=['tcp', 'unix'])
+def lapi(request, tmp_path):
+    """(FakeLAPI, url) serving on a local TCP port or a unix socket"""
+    fake = FakeLAPI()
+    if request.param == 'tcp':
+        server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(fake))
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+    else:
+        path = str(tmp_path / 'lapi.sock')
+        server = UnixHTTPServer(path, make_handler(fake))
+        url = f"unix://{path}"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield fake, url
+    server.shutdown()
+    server.server_close()
+
+
+def dispatcher(tmp_path, url, **kwargs):
+    options = {'batch': 50, 'interval_ms': 20, 'retries': 3, 'backoff': 0.01,
+               'max_backoff': 0.05, 'timeout': 2}
+    options.update(kwargs)
+    bans = BanDispatcher(str(tmp_path / 'autoban-requests.log'), **options)
+    bans.configure(url, 'secubox-waf', 'secret')
+    return bans
+
+
+def ban(i):
+    return {'ip': f"203.0.113.{i % 250 + 1}" if i < 250 else f"198.51.100.{i % 250 + 1}",
+            'reason': 'sqli', 'severity': 'critical', 'duration': '4h'}
+
+
+def fallback_lines(bans):
+    if not os.path.exists(bans.fallback_path):
+        return []
+    with open(bans.fallback_path) as f:
+        return [json.loads(line) for line in f]
+
+
+def run(bans, count, settle=lambda b: not b.queue and not b._inflight):
+    """Submit count bans on a running dispatcher and wait until it is idle"""
+    async def scenario():
+        bans.start()
+        accepted = [bans.submit(ban(i)) for i in range(count)]
+        for _ in range(500):
+            await asyncio.sleep(0.01)
+            if settle(bans):
+                break
+        bans.close()
+        return accepted
+
+    return asyncio.run(scenario())
+
+
+def test_batches_one_login(lapi, tmp_path):
+    fake, url = lapi
+    bans = dispatcher(tmp_path, url)
+    accepted = run(bans, 120, settle=lambda b: b.sent == 120)
+    assert all(accepted)
+    assert [len(post['alerts']) for post in fake.posts] == [50, 50, 20]
+    assert len(fake.logins) == 1
+    assert fake.logins[0]['machine_id'] == 'secubox-waf'
+    assert all(post['auth'] == 'Bearer token-1' for post in fake.posts)
+    assert sorted(fake.banned()) == sorted(ban(i)['ip'] for i in range(120))
+    decision = fake.posts[0]['alerts'][0]['decisions'][0]
+    assert decision['type'] == 'ban' and decision['origin'] == 'cscli' and decision['duration'] == '4h'
+    stats = bans.stats()
+    assert stats['sent'] == 120 and stats['batches'] == 3 and stats['fallback'] == 0
+    latency = stats['latency_ms']
+    assert 0 < latency['p50'] <= latency['p95'] <= latency['max']
+    assert fallback_lines(bans) == []
+
+
+def test_retries_5xx_and_429_with_backoff(lapi, tmp_path):
+    fake, url = lapi
+    fake.alert_status = [503, 429, 200]
+    bans = dispatcher(tmp_path, url)
+    run(bans, 3, settle=lambda b: b.sent == 3)
+    assert len(fake.posts) == 3
+    stats = bans.stats()
+    assert stats['retries'] == 2 and stats['sent'] == 3 and stats['fallback'] == 0
+    assert 'HTTP 429' in stats['last_error']
+    # Two waits of backoff then 2 x backoff before the accepted attempt
+    assert stats['latency_ms']['max'] >= 30
+
+
+def test_logs_in_again_after_401(lapi, tmp_path):
+    fake, url = lapi
+    fake.alert_status = [401, 200]
+    bans = dispatcher(tmp_path, url)
+    run(bans, 1, settle=lambda b: b.sent == 1)
+    assert len(fake.logins) == 2
+    assert [post['auth'] for post in fake.posts] == ['Bearer token-1', 'Bearer token-2']
+    assert bans.stats()['retries'] == 0 and bans.stats()['logins'] == 2
+
+
+def test_rejected_login_is_not_retried(lapi, tmp_path):
+    fake, url = lapi
+    fake.login_status = [403]
+    bans = dispatcher(tmp_path, url)
+    run(bans, 2, settle=lambda b: b.fallback == 2)
+    assert len(fake.logins) == 1
+    assert fake.posts == []
+    stats = bans.stats()
+    assert stats['retries'] == 0 and stats['sent'] == 0 and stats['fallback'] == 2
+    assert 'LAPI login: HTTP 403' in stats['last_error']
+    assert [line['ip'] for line in fallback_lines(bans)] == [ban(0)['ip'], ban(1)['ip']]
+
+
+def test_persistent_failure_falls_back_to_file(lapi, tmp_path):
+    fake, url = lapi
+    fake.alert_status = [500]
+    bans = dispatcher(tmp_path, url, retries=2)
+    run(bans, 5, settle=lambda b: b.fallback == 5)
+    assert len(fake.posts) == 3
+    lines = fallback_lines(bans)
+    assert [line['ip'] for line in lines] == [ban(i)['ip'] for i in range(5)]
+    assert all('_queued' not in line for line in lines)
+    assert bans.stats()['sent'] == 0 and bans.stats()['retries'] == 2
+
+
+def test_close_writes_queued_bans_to_file(lapi, tmp_path):
+    fake, url = lapi
+    bans = dispatcher(tmp_path, url, interval_ms=10000)
+
+    async def scenario():
+        bans.start()
+        accepted = [bans.submit(ban(i)) for i in range(4)]
+        # The sender is waiting for more bans of the burst
+        await asyncio.sleep(0.05)
+        bans.close()
+        return accepted
+
+    assert all(asyncio.run(scenario()))
+    assert fake.posts == []
+    assert [line['ip'] for line in fallback_lines(bans)] == [ban(i)['ip'] for i in range(4)]
+    assert bans.stats()['fallback'] == 4
+
+
+def test_without_api_bans_go_to_file(tmp_path):
+    bans = BanDispatcher(str(tmp_path / 'autoban-requests.log'))
+    assert bans.submit(ban(0)) is False
+    assert [line['ip'] for line in fallback_lines(bans)] == [ban(0)['ip']]
@@ -124,6 +124,7 @@ class Alert:
     type: str
     message: str
     severity: str = "info"
+    seq: int = 0
 
 
 # ============================================================================
@@ -135,6 +136,7 @@ class DeviceManager:
     def __init__(self):
         self.devices: Dict[str, Device] = {}
         self.alerts: List[Alert] = []
+        self._alert_cursors: Dict[str, int] = {}  # {device name: last alert seq seen}
         self._ssh_cache = {}
         self._services_cache: Dict[str, tuple] = {}  # {host: (timestamp, services)}
         self._services_cache_ttl = 60  # Cache services for 60 seconds
@@ -358,26 +360,53 @@ class DeviceManager:
             except:
                 pass
 
-    def get_alerts(self, device: Device) -> List[Alert]:
-        """Fetch security alerts from device"""
+    def _read_alerts(self, device: Device) -> List[dict]:
+        """Raw alerts file of device, oldest first"""
         out, err, code = self.ssh_exec(device, "cat /tmp/secubox-mitm-alerts.json 2>/dev/null")
-        alerts = []
-
         if code == 0 and out.strip():
             try:
                 data = json.loads(out)
-                for a in data[-10:]:  # Last 10
-                    alerts.append(Alert(
-                        timestamp=a.get("time", ""),
-                        device=device.name,
-                        type=a.get("type", ""),
-                        message=f"{a.get('ip', '')} - {a.get('path', '')}",
-                        severity="warning" if a.get("type") == "scan" else "info"
-                    ))
-            except:
+                if isinstance(data, list):
+                    return [a for a in data if isinstance(a, dict)]
+            except ValueError:
                 pass
+        return []
 
-        return alerts
+    def _to_alerts(self, device: Device, data: List[dict]) -> List[Alert]:
+        return [Alert(
+            timestamp=a.get("time", ""),
+            device=device.name,
+            type=a.get("type", ""),
+            message=f"{a.get('ip', '')} - {a.get('path', '')}",
+            severity="warning" if a.get("type") == "scan" else "info",
+            seq=a.get("seq", 0)
+        ) for a in data]
+
+    def get_alerts(self, device: Device, since: Optional[int] = None) -> List[Alert]:
+        """Fetch security alerts from device: the last 10, or all those after sequence number since"""
+        data = self._read_alerts(device)
+        if since is None:
+            data = data[-10:]  # Last 10
+        else:
+            data = [a for a in data if a.get("seq", 0) > since]
+        return self._to_alerts(device, data)
+
+    def get_new_alerts(self, device: Device) -> List[Alert]:
+        """Alerts of device not returned by a previous call, all of them: the
+        cursor moves past every alert returned"""
+        data = self._read_alerts(device)
+        if data and "seq" not in data[-1]:
+            # Addon without sequence numbers: no cursor possible
+            return self._to_alerts(device, data)
+        cursor = self._alert_cursors.get(device.name, 0)
+        if data and data[-1].get("seq", 0) < cursor:
+            # The sequence went backwards: the addon started over with an
+            # empty alerts file
+            cursor = 0
+        data = [a for a in data if a.get("seq", 0) > cursor]
+        if data:
+            self._alert_cursors[device.name] = data[-1].get("seq", 0)
+        return self._to_alerts(device, data)
 
     def create_backup(self, device: Device, name: str = None) -> bool:
         """Create backup on device"""
@@ -879,7 +908,7 @@ Services: {services}"""
                 if dev.status != "online":
                     continue
 
-                alerts = self.manager.get_alerts(dev)
+                alerts = self.manager.get_new_alerts(dev)
                 for alert in alerts:
                     severity_color = "yellow" if alert.severity == "warning" else "blue"
                     log.write_line(
@@ -0,0 +1,62 @@
+"""
+Alert polling of the console frontend (DeviceManager.get_new_alerts)
+Run: python3 -m pytest tests/test_alerts.py
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'root', 'usr', 'lib', 'secubox-console'))
+
+import secubox_frontend  # noqa: E402
+from secubox_frontend import Device, DeviceManager  # noqa: E402
+
+
+@pytest.fixture
+def manager(tmp_path, monkeypatch):
+    """DeviceManager with its config dir in tmp_path and a scripted alerts file"""
+    config = tmp_path / 'config'
+    monkeypatch.setattr(secubox_frontend, 'CONFIG_DIR', config)
+    monkeypatch.setattr(secubox_frontend, 'DEVICES_FILE', config / 'devices.json')
+    monkeypatch.setattr(secubox_frontend, 'SETTINGS_FILE', config / 'settings.json')
+    monkeypatch.setattr(secubox_frontend, 'NODE_ID_FILE', config / 'node.id')
+    mgr = DeviceManager()
+    mgr.alerts_file = []
+    monkeypatch.setattr(mgr, '_read_alerts', lambda device: list(mgr.alerts_file))
+    return mgr
+
+
+def alerts(first, last, capacity=100):
+    """Alerts file content after alerts first..last, as kept by the addon's ring"""
+    return [{'seq': n, 'time': f"t{n}", 'type': 'scan', 'ip': '203.0.113.7', 'path': f"/p{n}"}
+            for n in range(max(first, last - capacity + 1), last + 1)]
+
+
+def test_burst_between_polls_returns_every_alert(manager):
+    device = Device(name='gw', host='192.0.2.1')
+    manager.alerts_file = alerts(1, 3)
+    assert [a.seq for a in manager.get_new_alerts(device)] == [1, 2, 3]
+    # 25 alerts arrive before the next poll
+    manager.alerts_file = alerts(1, 28)
+    assert [a.seq for a in manager.get_new_alerts(device)] == list(range(4, 29))
+    assert manager.get_new_alerts(device) == []
+    manager.alerts_file = alerts(1, 30)
+    assert [a.seq for a in manager.get_new_alerts(device)] == [29, 30]
+
+
+def test_restarted_addon_starts_over(manager):
+    device = Device(name='gw', host='192.0.2.1')
+    manager.alerts_file = alerts(1, 40)
+    assert len(manager.get_new_alerts(device)) == 40
+    manager.alerts_file = alerts(1, 12)
+    assert [a.seq for a in manager.get_new_alerts(device)] == list(range(1, 13))
+
+
+def test_get_alerts_lists_the_last_ten(manager):
+    device = Device(name='gw', host='192.0.2.1')
+    manager.alerts_file = alerts(1, 30)
+    assert [a.seq for a in manager.get_alerts(device)] == list(range(21, 31))
+    assert [a.seq for a in manager.get_alerts(device, since=5)] == list(range(6, 31))
@@ -24,7 +24,22 @@ from pathlib import Path
 from collections import deque
 from typing import Optional, Dict, Any, List
 from mitmproxy import http, ctx
-from mitmproxy.net.http import Response
+
+# Shared IP reputation table and auto-ban whitelist of the
+# secubox-app-mitmproxy addons (same addons dir)
+try:
+    from waf_reputation import ReputationStore, BAD_SCORE, LOCAL_PREFIXES, SEVERITY_POINTS
+    from waf_autoban import AutobanConfigWatcher, NetworkSet
+except ImportError:
+    ReputationStore = None
+
+REPUTATION_FILE = "/shared/ip-reputation.db"
+# Written by the host from UCI; its whitelist is never reported
+AUTOBAN_CONFIG = "/data/autoban.json"
+BUFFER_DIR = "/tmp/dpi-buffer"
+STATS_DIR = "/tmp/secubox"
+# Threat score added for a client the shared table knows as bad
+REPUTATION_THREAT_SCORE = 25
 
 
 class DPIBuffer:
@@ -33,16 +48,32 @@ class DPIBuffer:
     def __init__(self):
         self.buffer_size = 1000
         self.buffer: deque = deque(maxlen=self.buffer_size)
-        self.buffer_dir = Path("/tmp/dpi-buffer")
-        self.stats_file = Path("/tmp/secubox/dpi-buffer.json")
-        self.alerts_file = Path("/tmp/secubox/waf-alerts.json")
-        self.replay_queue_file = Path("/tmp/dpi-buffer/replay-queue.json")
+        # Buffered entries by flow id (response) and by req_hash (replay),
+        # kept in step with the ring buffer by _buffer_entry()
+        self.by_flow: Dict[str, Dict[str, Any]] = {}
+        self.by_hash: Dict[str, Dict[str, Any]] = {}
+        self.buffer_dir = Path(BUFFER_DIR)
+        self.stats_file = Path(STATS_DIR) / "dpi-buffer.json"
+        self.alerts_file = Path(STATS_DIR) / "waf-alerts.json"
+        self.replay_queue_file = self.buffer_dir / "replay-queue.json"
         self.analysis_enabled = True
         self.replay_enabled = True
         self.request_count = 0
         self.threat_count = 0
         self.blocked_count = 0
 
+        # Shared IP reputation: consulted in the quick check, fed by the
+        # async analysis
+        self.reputation = None
+        if ReputationStore is not None:
+            self.reputation = ReputationStore(REPUTATION_FILE)
+            if not self.reputation.open():
+                ctx.log.warn(f"DPI Buffer: shared IP reputation disabled: {self.reputation.last_error}")
+                self.reputation = None
+        if self.reputation is not None:
+            self.autoban_watcher = AutobanConfigWatcher(AUTOBAN_CONFIG)
+            self.whitelist = self._load_whitelist(self.autoban_watcher.load())
+
         # Threat detection patterns
         self.threat_patterns = {
             "path_traversal": [
@@ -118,6 +149,8 @@ class DPIBuffer:
             self.buffer_size = ctx.options.dpi_buffer_size
             new_buffer = deque(self.buffer, maxlen=self.buffer_size)
             self.buffer = new_buffer
+            self.by_flow = {e["flow_id"]: e for e in self.buffer}
+            self.by_hash = {e["req_hash"]: e for e in self.buffer}
 
         if "dpi_async_analysis" in updated:
             self.analysis_enabled = ctx.options.dpi_async_analysis
@@ -144,17 +177,18 @@ class DPIBuffer:
         # Block if enabled and high threat score
         if ctx.options.dpi_block_threats and threat_result["score"] >= 50:
             self.blocked_count += 1
-            flow.response = Response.make(
+            flow.response = http.Response.make(
                 403,
                 b"Request blocked by DPI analysis",
                 {"Content-Type": "text/plain"}
             )
             entry["blocked"] = True
             self._log_threat_sync(entry)
+            self._report_reputation(entry)
             return
 
         # Add to buffer
-        self.buffer.append(entry)
+        self._buffer_entry(entry)
 
         # Queue for async deep analysis if enabled
         if self.analysis_enabled:
@@ -169,16 +203,28 @@ class DPIBuffer:
         if not flow.request.timestamp_start:
             return
 
-        req_hash = self._request_hash(flow)
-        for entry in self.buffer:
-            if entry.get("req_hash") == req_hash:
-                entry["response"] = {
-                    "status": flow.response.status_code if flow.response else None,
-                    "content_length": len(flow.response.content) if flow.response and flow.response.content else 0,
-                    "content_type": flow.response.headers.get("content-type", "") if flow.response else "",
-                    "latency_ms": int((time.time() - entry["ts"]) * 1000),
-                }
-                break
+        entry = self.by_flow.get(flow.id)
+        if entry is not None:
+            entry["response"] = {
+                "status": flow.response.status_code if flow.response else None,
+                "content_length": len(flow.response.content) if flow.response and flow.response.content else 0,
+                "content_type": flow.response.headers.get("content-type", "") if flow.response else "",
+                "latency_ms": int((time.time() - entry["ts"]) * 1000),
+            }
+
+    def _buffer_entry(self, entry: Dict[str, Any]):
+        """Append to the ring buffer, dropping the evicted entry from the indexes."""
+        if not self.buffer.maxlen:
+            return
+        if len(self.buffer) == self.buffer.maxlen:
+            evicted = self.buffer.popleft()
+            if self.by_flow.get(evicted["flow_id"]) is evicted:
+                del self.by_flow[evicted["flow_id"]]
+            if self.by_hash.get(evicted["req_hash"]) is evicted:
+                del self.by_hash[evicted["req_hash"]]
+        self.buffer.append(entry)
+        self.by_flow[entry["flow_id"]] = entry
+        self.by_hash[entry["req_hash"]] = entry
 
     def _build_entry(self, flow: http.HTTPFlow) -> Dict[str, Any]:
         """Build a buffer entry from a flow."""
@@ -204,6 +250,7 @@ class DPIBuffer:
 
         return {
             "ts": flow.request.timestamp_start,
+            "flow_id": flow.id,
             "req_hash": self._request_hash(flow),
             "method": flow.request.method,
             "host": flow.request.host,
@@ -263,6 +310,12 @@ class DPIBuffer:
             if "content-type" not in [k.lower() for k in headers.keys()]:
                 score += 10
 
+        # Known bad to the mitmproxy instances
+        if self.reputation is not None:
+            if self.reputation.score(entry.get("client_ip", "")) >= BAD_SCORE:
+                categories.append("reputation")
+                score += REPUTATION_THREAT_SCORE
+
         return {"score": min(score, 100), "categories": categories}
 
     async def _async_analyze(self, entry: Dict[str, Any]):
@@ -291,10 +344,38 @@ class DPIBuffer:
             if entry["threat_score"] > 30:
                 self.threat_count += 1
                 await self._log_threat(entry)
+                self._report_reputation(entry)
 
         except Exception as e:
             ctx.log.error(f"DPI Buffer analysis error: {e}")
 
+    @staticmethod
+    def _load_whitelist(config: Optional[dict]) -> "NetworkSet":
+        return NetworkSet.parse((config or {}).get("whitelist", []))
+
+    def _report_reputation(self, entry: Dict[str, Any]):
+        """
+        Add a detected threat to the client's shared reputation score.
+
+        Whitelisted and local clients are skipped, as in the analytics addon.
+        """
+        if self.reputation is None:
+            return
+        config = self.autoban_watcher.poll()
+        if config is not None:
+            self.whitelist = self._load_whitelist(config)
+        ip = entry.get("client_ip", "")
+        if ip in self.whitelist or ip.startswith(LOCAL_PREFIXES):
+            return
+        # Only what was found in this request; the reputation bonus itself
+        # is not fed back
+        score = entry["threat_score"]
+        if "reputation" in entry["threat_categories"]:
+            score -= REPUTATION_THREAT_SCORE
+        if score > 30:
+            severity = "high" if score >= 50 else "medium"
+            self.reputation.report(ip, SEVERITY_POINTS[severity])
+
     def _log_threat_sync(self, entry: Dict[str, Any]):
         """Synchronous threat logging for blocked requests."""
         try:
@@ -359,6 +440,7 @@ class DPIBuffer:
                 "top_hosts": dict(top_hosts),
                 "analysis_enabled": self.analysis_enabled,
                 "replay_enabled": self.replay_enabled,
+                "reputation": self.reputation.stats() if self.reputation is not None else None,
             }
             self.stats_file.write_text(json.dumps(stats, indent=2))
         except Exception as e:
@@ -405,12 +487,7 @@ class DPIBuffer:
             return False
 
         # Find the request in buffer
-        entry = None
-        for e in self.buffer:
-            if e.get("req_hash") == req_hash:
-                entry = e
-                break
-
+        entry = self.by_hash.get(req_hash)
         if not entry:
             return False
 
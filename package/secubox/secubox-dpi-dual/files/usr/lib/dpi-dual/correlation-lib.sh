@@ -11,6 +11,40 @@ CORRELATION_LOG="$STATS_DIR/correlated-threats.json"
 WAF_ALERTS="$STATS_DIR/waf-alerts.json"
 MITM_LOG="/var/log/mitmproxy/access.log"
 
+# Reputation table: served from memory by dpi-reputation (procd instance
+# "reputation"), which writes $REPUTATION_DB. Commands go to its socket
+# through socat or nc -U when one is installed: that is a small process per
+# event, where $REPUTATION_CMD starts python3. Without a client or without
+# the service, $REPUTATION_CMD runs them (on the file under a lock)
+REPUTATION_CMD="/usr/sbin/dpi-reputation"
+REPUTATION_SOCK="/var/run/dpi-reputation.sock"
+
+# Socket client, picked once when the library is sourced
+if command -v socat >/dev/null 2>&1; then
+    REPUTATION_CLIENT="socat"
+elif command -v nc >/dev/null 2>&1 && nc -h 2>&1 | grep -q -- '-U' && nc -h 2>&1 | grep -q -- '-N'; then
+    REPUTATION_CLIENT="nc"
+else
+    REPUTATION_CLIENT="none"
+fi
+
+# Send one command line to the service and print its answer; fails when it
+# cannot be sent or is refused, the caller then runs $REPUTATION_CMD
+reputation_request() {
+    local answer
+
+    [ -S "$REPUTATION_SOCK" ] || return 1
+    case "$REPUTATION_CLIENT" in
+        socat) answer=$(echo "$*" | socat -t 5 - "UNIX-CONNECT:$REPUTATION_SOCK" 2>/dev/null) ;;
+        nc) answer=$(echo "$*" | nc -N -U "$REPUTATION_SOCK" 2>/dev/null) ;;
+        *) return 1 ;;
+    esac
+    case "$answer" in
+        ""|error*) return 1 ;;
+    esac
+    echo "$answer"
+}
+
 # Initialize reputation database
 init_reputation_db() {
     [ ! -f "$REPUTATION_DB" ] && echo '{}' > "$REPUTATION_DB"
@@ -19,10 +53,9 @@ init_reputation_db() {
 # Get IP reputation score (0-100, higher = more suspicious)
 get_ip_reputation() {
     local ip="$1"
-    init_reputation_db
-
     local score
-    score=$(jsonfilter -i "$REPUTATION_DB" -e "@[\"$ip\"].score" 2>/dev/null)
+
+    score=$(reputation_request get "$ip") || score=$("$REPUTATION_CMD" get "$ip" 2>/dev/null)
     echo "${score:-0}"
 }
 
@@ -32,98 +65,26 @@ update_ip_reputation() {
     local event_type="$2"  # threat, alert, block, clean
     local delta="$3"       # score change
 
-    init_reputation_db
-
-    local current_score last_seen event_count
-    current_score=$(jsonfilter -i "$REPUTATION_DB" -e "@[\"$ip\"].score" 2>/dev/null || echo 0)
-    event_count=$(jsonfilter -i "$REPUTATION_DB" -e "@[\"$ip\"].events" 2>/dev/null || echo 0)
-
-    # Calculate new score
-    local new_score=$((current_score + delta))
-    [ "$new_score" -lt 0 ] && new_score=0
-    [ "$new_score" -gt 100 ] && new_score=100
-
-    event_count=$((event_count + 1))
-
-    # Build updated entry
-    local tmp_file="/tmp/reputation_update_$$.json"
-    cat "$REPUTATION_DB" > "$tmp_file"
-
-    # Update using shell (jsonfilter is read-only)
-    local now
-    now=$(date -Iseconds)
-
-    # Simple JSON update - replace or add entry
-    if grep -q "\"$ip\"" "$tmp_file"; then
-        # Update existing - this is simplified, full implementation would use jq
-        sed -i "s/\"$ip\":{[^}]*}/\"$ip\":{\"score\":$new_score,\"events\":$event_count,\"last_event\":\"$event_type\",\"updated\":\"$now\"}/" "$tmp_file"
-    else
-        # Add new entry
-        sed -i "s/^{/{\n\"$ip\":{\"score\":$new_score,\"events\":$event_count,\"last_event\":\"$event_type\",\"updated\":\"$now\"},/" "$tmp_file"
-    fi
-
-    mv "$tmp_file" "$REPUTATION_DB"
+    reputation_request update "$ip" "$event_type" "$delta" >/dev/null ||
+        "$REPUTATION_CMD" update "$ip" "$event_type" "$delta" >/dev/null
 }
 
 # Decay all IP reputations by a fixed amount
-# Called periodically to let old threats "heal"
+# Scores also decay on their own (reputation_decay points every
+# decay_interval seconds); this takes amount off on top of that
 decay_all_reputations() {
     local decay_amount="${1:-5}"
 
-    init_reputation_db
-
-    [ ! -f "$REPUTATION_DB" ] && return 0
-
-    local tmp_file="/tmp/reputation_decay_$$.json"
-    local now
-    now=$(date -Iseconds)
-
-    # Process each IP in the reputation DB
-    # Extract IPs and their scores, apply decay
-    local ip score new_score
-
-    # Read current state
-    cp "$REPUTATION_DB" "$tmp_file"
-
-    # Get all IPs from the JSON
-    local ips
-    ips=$(grep -oE '"[0-9]+\.[0-9]+\.[0-9]+\.[0-9]+"' "$REPUTATION_DB" | tr -d '"' | sort -u)
-
-    for ip in $ips; do
-        score=$(jsonfilter -i "$REPUTATION_DB" -e "@[\"$ip\"].score" 2>/dev/null || echo 0)
-        new_score=$((score - decay_amount))
-        [ "$new_score" -lt 0 ] && new_score=0
-
-        if [ "$new_score" -eq 0 ]; then
-            # Remove entries that have decayed to 0
-            sed -i "s/\"$ip\":{[^}]*},\?//" "$tmp_file"
-        else
-            # Update score
-            sed -i "s/\"$ip\":{\"score\":[0-9]*/\"$ip\":{\"score\":$new_score/" "$tmp_file"
-        fi
-    done
-
-    # Clean up JSON (remove trailing commas, empty entries)
-    sed -i 's/,\s*}/}/g; s/{\s*,/{/g; s/,,/,/g' "$tmp_file"
-
-    mv "$tmp_file" "$REPUTATION_DB"
+    reputation_request decay "$decay_amount" >/dev/null ||
+        "$REPUTATION_CMD" decay "$decay_amount" >/dev/null
 }
 
 # Reset reputation for a specific IP
 reset_ip_reputation() {
     local ip="$1"
 
-    init_reputation_db
-    [ ! -f "$REPUTATION_DB" ] && return 0
-
-    local tmp_file="/tmp/reputation_reset_$$.json"
-    cp "$REPUTATION_DB" "$tmp_file"
-
-    # Remove the IP entry
-    sed -i "s/\"$ip\":{[^}]*},\?//" "$tmp_file"
-    sed -i 's/,\s*}/}/g; s/{\s*,/{/g; s/,,/,/g' "$tmp_file"
-
-    mv "$tmp_file" "$REPUTATION_DB"
+    reputation_request reset "$ip" >/dev/null ||
+        "$REPUTATION_CMD" reset "$ip" >/dev/null
     echo "Reset reputation for $ip"
 }
 